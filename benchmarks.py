@@ -0,0 +1,485 @@
+"""Micro-benchmarks do bot de vendas.
+
+Cada subcomando mede uma parte isolada do bot sobre uma cópia descartável do
+banco (nenhuma chamada vai ao Telegram) e mostra o antes e o depois lado a lado:
+
+    handlers     acesso a dados dos handlers: conexão nova por chamada (como era)
+                 x pool de conexões fora do event loop x cache do catálogo
+    persistence  cliques por segundo com as sessões persistidas no SQLite x só
+                 na memória (a Application completa, contra a Bot API falsa do
+                 `loadtest.py`)
+    router       custo de despachar um callback: a antiga cadeia if/elif (com e
+                 sem o log INFO de cada clique) x o `callback_router`
+    catalog      linhas por segundo da importação (inserção e upsert) e da
+                 exportação do catálogo, em CSV e JSONL, com o pico de memória
+    search       tempo por busca (/buscar e modo inline) num catálogo grande,
+                 com termos seletivos e amplos: bm25 sobre todos os resultados
+                 (como era) x busca atual com candidatos limitados
+    inline       latência do `inline_query_handler` com o cache de respostas
+                 vazio (miss) x com a resposta já montada (hit), em catálogos de
+                 tamanhos crescentes
+
+Uso:
+    python benchmarks.py handlers --calls 5000 --concurrency 100
+    python benchmarks.py persistence --users 500 --clicks 10
+    python benchmarks.py router --iterations 200000
+    python benchmarks.py catalog --rows 200000
+    python benchmarks.py search --rows 100000
+    python benchmarks.py inline --sizes 1000 10000 100000
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+FAKE_BOT_TOKEN = "123456:BENCHMARK"
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class LoopLagMonitor:
+    """Mede o quanto o event loop ficou travado: uma tarefa que dorme 1 ms e anota o atraso ao acordar."""
+
+    def __init__(self, interval: float = 0.001):
+        self.interval = interval
+        self.max_lag = 0.0
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.max_lag = max(self.max_lag, time.perf_counter() - started - self.interval)
+
+    def __enter__(self) -> "LoopLagMonitor":
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._task.cancel()
+
+
+# --- handlers: acesso a dados ---
+def legacy_fetch_product_by_id(database: str, product_id: int):
+    """Como os handlers buscavam um produto antes do pool: conexão nova, consulta bloqueante no event loop."""
+    conn = sqlite3.connect(database)
+    conn.row_factory = sqlite3.Row
+    row = conn.execute("SELECT * FROM products WHERE id = ?", (product_id,)).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+async def bench_handlers(args) -> None:
+    import vendas # Importado só aqui: as variáveis de ambiente já apontam para o banco descartável
+
+    vendas.catalog_cache.load(vendas.setup_database())
+    product_ids = [product["id"] for product in vendas.catalog_cache.all()]
+
+    def pooled_fetch(product_id: int):
+        with vendas.get_db_pool().connection() as conn:
+            row = conn.execute(f"SELECT {vendas.PRODUCT_COLUMNS} FROM products WHERE id = ?", (product_id,)).fetchone()
+            return vendas._product_from_row(row) if row else None
+
+    async def legacy(product_id: int):
+        return legacy_fetch_product_by_id(vendas.DATABASE_FILE, product_id)
+
+    variants = {
+        "conexão por chamada (antes)": legacy,
+        "pool de conexões": lambda product_id: vendas.get_db_pool().run(pooled_fetch, product_id),
+        "cache do catálogo (atual)": vendas.get_product,
+    }
+    api_latency = args.api_latency_ms / 1000
+
+    print(f"\n{args.calls} handlers, {args.concurrency} simultâneos, {args.api_latency_ms} ms de API simulada\n")
+    print(f"{'acesso a dados':<30}{'handlers/s':>12}{'p50 (ms)':>10}{'p99 (ms)':>10}{'loop travado (ms)':>19}")
+    for name, lookup in variants.items():
+        latencies: list = []
+        remaining = iter(range(args.calls))
+
+        async def simulated_handler() -> None:
+            # Um handler típico: busca o produto e depois espera a resposta do Telegram
+            for index in remaining:
+                started = time.perf_counter()
+                await lookup(product_ids[index % len(product_ids)])
+                if api_latency:
+                    await asyncio.sleep(api_latency)
+                latencies.append(time.perf_counter() - started)
+
+        with LoopLagMonitor() as lag:
+            started = time.perf_counter()
+            await asyncio.gather(*(simulated_handler() for _ in range(args.concurrency)))
+            elapsed = time.perf_counter() - started
+        print(f"{name:<30}{args.calls / elapsed:>12.0f}{percentile(latencies, 0.50) * 1000:>10.2f}"
+              f"{percentile(latencies, 0.99) * 1000:>10.2f}{lag.max_lag * 1000:>19.2f}")
+    vendas.get_db_pool().close()
+
+
+# --- persistence: cliques por segundo ---
+async def bench_persistence(args) -> None:
+    import loadtest
+
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{args.api_port}"
+    os.environ["BOT_MODE"] = "webhook" # Sem Updater: os updates são entregues direto ao processador
+    os.environ["PERSISTENCE_FLUSH_INTERVAL"] = str(args.flush_interval)
+    for name in ("OUTBOUND_GLOBAL_RATE", "OUTBOUND_CHAT_RATE", "OUTBOUND_CHAT_BURST"):
+        os.environ[name] = "1000000"
+    import vendas
+
+    product_ids = loadtest.prepare_store(vendas)
+    print(f"\n{args.users} usuários x {args.clicks} cliques em 'add_one_', gravação a cada {args.flush_interval}s\n")
+    print(f"{'sessões':<22}{'cliques/s':>11}{'p50 (ms)':>10}{'p99 (ms)':>10}{'gravação final (ms)':>21}{'sessões no banco':>18}")
+    with loadtest.FakeAPIProcess(args.api_port):
+        for offset, (name, persistence) in enumerate((("só na memória", False), ("SQLite (em lote)", True))):
+            first_user = 1000 + offset * args.users # Usuários novos a cada rodada: nenhuma sessão já carregada
+            steps = [("add_one_", "callback", f"add_one_{product_ids[0]}")] * args.clicks
+            application = vendas.build_application(persistence=persistence)
+            latencies: dict = {}
+            update_ids = iter(range(1, 1 << 62))
+            async with application:
+                await application.start()
+                started = time.perf_counter()
+                await asyncio.gather(*(
+                    loadtest.run_user(vendas, application, user_id, steps, 0, latencies, update_ids)
+                    for user_id in range(first_user, first_user + args.users)
+                ))
+                elapsed = time.perf_counter() - started
+                stopping = time.perf_counter()
+                await application.stop() # Com persistência, grava as sessões ainda pendentes
+                final_flush = time.perf_counter() - stopping
+            with sqlite3.connect(vendas.DATABASE_FILE) as conn:
+                stored = conn.execute(
+                    "SELECT COUNT(*) FROM user_sessions WHERE user_id BETWEEN ? AND ?", (first_user, first_user + args.users - 1)
+                ).fetchone()[0]
+            clicks = latencies["add_one_"]
+            print(f"{name:<22}{len(clicks) / elapsed:>11.0f}{percentile(clicks, 0.50) * 1000:>10.2f}"
+                  f"{percentile(clicks, 0.99) * 1000:>10.2f}{final_flush * 1000:>21.1f}{stored:>18}")
+
+
+# --- router: custo do despacho ---
+ROUTER_SAMPLES = (
+    "show_products", "show_products:2", "show_cart", "view_product_3", "add_one_3", "remove_one_3",
+    "checkout_cart", "show_donation", "donate_custom", "donate_1000", "search:1", "desconhecido",
+)
+
+def legacy_dispatch(data: str, log: logging.Logger):
+    """As checagens da antiga cadeia if/elif do `inline_button_handler`, sem chamar os handlers."""
+    log.info(f"Callback recebido: {data}")
+    if data == "show_products":
+        return "products_handler", ()
+    elif data == "show_cart":
+        return "cart_handler", ()
+    elif data.startswith("view_product_"):
+        try: # O `view_product_handler` repetia o split para achar o ID
+            return "view_product_handler", (int(data.split("_")[-1]),)
+        except (IndexError, ValueError):
+            return None
+    elif data.startswith("add_one_"):
+        try:
+            return "add_one", (int(data.split("_")[-1]),)
+        except (IndexError, ValueError):
+            return None
+    elif data.startswith("remove_one_"):
+        try:
+            return "remove_one", (int(data.split("_")[-1]),)
+        except (IndexError, ValueError):
+            return None
+    elif data == "checkout_cart":
+        return "checkout_handler", ()
+    elif data == "show_donation":
+        return "donation_handler", ()
+    elif data.startswith("donate_"):
+        if data == "donate_custom":
+            return "donate_custom", ()
+        try:
+            return "process_donation", (int(data.split("_")[-1]),)
+        except (IndexError, ValueError):
+            return None
+    return None
+
+
+async def bench_router(args) -> None:
+    import vendas
+
+    def per_call_ns(dispatch, data: str) -> float:
+        started = time.perf_counter_ns()
+        for _ in range(args.iterations):
+            dispatch(data)
+        return (time.perf_counter_ns() - started) / args.iterations
+
+    # O log INFO da versão antiga vai para /dev/null: mede formatar e escrever, sem poluir o terminal
+    info_log = logging.getLogger("benchmarks.legacy_info")
+    info_log.addHandler(logging.StreamHandler(open(os.devnull, "w")))
+    info_log.setLevel(logging.INFO)
+    info_log.propagate = False
+    quiet_log = logging.getLogger("benchmarks.legacy_quiet")
+    quiet_log.setLevel(logging.WARNING)
+
+    def router_dispatch(data: str):
+        route = vendas.callback_router.resolve(data)
+        vendas.logger.debug("Callback: data=%r", data) # Como no inline_button_handler: DEBUG, desligado por padrão
+        return route
+
+    variants = {
+        "if/elif + log INFO": lambda data: legacy_dispatch(data, info_log),
+        "if/elif sem log": lambda data: legacy_dispatch(data, quiet_log),
+        "callback_router": router_dispatch,
+    }
+    print(f"\nCusto por callback (ns), média de {args.iterations} despachos\n")
+    print(f"{'callback_data':<18}" + "".join(f"{name:>21}" for name in variants))
+    totals = dict.fromkeys(variants, 0.0)
+    for data in ROUTER_SAMPLES:
+        row = f"{data:<18}"
+        for name, dispatch in variants.items():
+            cost = per_call_ns(dispatch, data)
+            totals[name] += cost
+            row += f"{cost:>21.0f}"
+        print(row)
+    print(f"{'média':<18}" + "".join(f"{total / len(ROUTER_SAMPLES):>21.0f}" for total in totals.values()))
+
+
+# --- catalog: importação/exportação ---
+def write_sample_catalog(path: str, fmt: str, rows: int) -> None:
+    """Gera um catálogo sintético de `rows` produtos, linha a linha."""
+    records = (
+        {
+            "sku": f"{fmt.upper()}-{index:07d}", "nome": f"Produto {index}", "preco": f"{index % 500 + 0.9:.2f}",
+            "descricao": f"Descrição do produto {index}", "imagem": f"https://exemplo.com/img/{index}.jpg",
+            "estoque": index % 100,
+        }
+        for index in range(rows)
+    )
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        if fmt == "csv":
+            writer = csv.DictWriter(f, fieldnames=("sku", "nome", "preco", "descricao", "imagem", "estoque"))
+            writer.writeheader()
+            writer.writerows(records)
+        else:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # ru_maxrss vem em KB no Linux
+
+
+async def bench_catalog(args) -> None:
+    import vendas
+
+    vendas.initialize_database()
+    workdir = os.path.dirname(vendas.DATABASE_FILE)
+    print(f"\n{args.rows} linhas por arquivo\n")
+    print(f"{'operação':<24}{'linhas':>10}{'tempo (s)':>11}{'linhas/s':>11}{'RSS máx. (MB)':>15}")
+    for fmt in ("csv", "jsonl"):
+        source = os.path.join(workdir, f"catalogo.{fmt}")
+        write_sample_catalog(source, fmt, args.rows)
+        steps = (
+            ("importar (novos)", lambda: vendas.import_catalog(source, fmt)),
+            ("importar (upsert)", lambda: vendas.import_catalog(source, fmt)), # Mesmos SKUs: caminho do UPDATE
+            ("exportar", lambda: vendas.export_catalog(os.path.join(workdir, f"exportado.{fmt}"), fmt)),
+        )
+        for name, step in steps:
+            started = time.perf_counter()
+            rows = step()
+            elapsed = time.perf_counter() - started
+            print(f"{fmt + ' ' + name:<24}{rows:>10}{elapsed:>11.2f}{rows / elapsed:>11.0f}{peak_rss_mb():>15.1f}")
+    vendas.get_db_pool().close()
+
+
+# --- search: busca em catálogo grande ---
+SAMPLE_KINDS = ("Camiseta", "Caneca", "Boné", "Calça", "Caderno", "Capa", "Mochila", "Chaveiro", "Adesivo", "Moletom")
+SAMPLE_STYLES = ("Azul", "Preta", "Branca", "Estampada", "Clássica", "Premium", "Básica", "Vintage")
+SAMPLE_MATERIALS = ("algodão", "poliéster", "cerâmica", "couro", "vinil")
+# Seletivos, prefixos digitados aos poucos e termos amplos (que casam com quase todo o catálogo)
+SEARCH_TERMS = (
+    "camiseta", "cam", "ca", "camiseta azul", "moletom vintage 123", "boné", "xyz",
+    "produto", "pro", "algodao", "qualidade", "produto de",
+)
+
+def fill_sample_catalog(vendas, rows: int, start: int = 0) -> None:
+    """Acrescenta `rows` produtos sintéticos (nomes e descrições com vocabulário repetido, como um catálogo real).
+
+    `start` é o número do primeiro produto, para crescer um catálogo já preenchido sem repetir SKUs.
+    """
+    sample = random.Random(start + 1)
+    products = (
+        (
+            f"BENCH-{index:07d}",
+            f"{sample.choice(SAMPLE_KINDS)} {sample.choice(SAMPLE_STYLES)} Produto {index}",
+            1000 + index % 5000,
+            f"Produto de {sample.choice(SAMPLE_MATERIALS)} de ótima qualidade, modelo {index}",
+            None,
+            None,
+        )
+        for index in range(start, start + rows)
+    )
+    with vendas.get_db_pool().connection() as conn:
+        with conn:
+            conn.executemany(
+                "INSERT INTO products (sku, nome, preco_centavos, descricao, imagem, estoque) VALUES (?, ?, ?, ?, ?, ?)",
+                products,
+            )
+    vendas.invalidate_catalog()
+
+
+def legacy_search_product_ids(vendas, term: str, limit: int, offset: int = 0) -> list:
+    """A busca antes do limite de candidatos: todas as palavras por prefixo e bm25 sobre todos os resultados."""
+    query = " ".join(f'"{word}"*' for word in vendas.re.findall(r"\w+", term))
+    if not query:
+        return []
+    with vendas.get_db_pool().connection() as conn:
+        rows = conn.execute(
+            "SELECT rowid FROM products_fts WHERE products_fts MATCH ? "
+            "ORDER BY bm25(products_fts, 10.0, 1.0) LIMIT ? OFFSET ?",
+            (query, limit, offset),
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+async def bench_search(args) -> None:
+    import vendas
+
+    vendas.setup_database()
+    fill_sample_catalog(vendas, args.rows)
+    limit = vendas.INLINE_QUERY_LIMIT + 1 # O que o modo inline pede por tecla
+    variants = {
+        "antes": lambda term: legacy_search_product_ids(vendas, term, limit),
+        "atual": lambda term: vendas.search_product_ids(term, limit),
+    }
+
+    print(f"\n{args.rows} produtos, {args.repeat} buscas por termo ({limit} resultados)\n")
+    print(f"{'termo':<22}{'resultados':>11}" + "".join(f"{name + ' p50':>12}{name + ' p99':>12}" for name in variants))
+    for term in args.terms or SEARCH_TERMS:
+        row = f"{term:<22}{len(vendas.search_product_ids(term, limit)):>11}"
+        for search in variants.values():
+            search(term) # Aquece o cache de páginas do SQLite
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                search(term)
+                timings.append(time.perf_counter() - started)
+            row += f"{percentile(timings, 0.50) * 1000:>12.2f}{percentile(timings, 0.99) * 1000:>12.2f}"
+        print(row)
+    print("\nTempos em ms.")
+    vendas.get_db_pool().close()
+
+
+# --- inline: cache de respostas inline ---
+INLINE_TERMS = ("", "camiseta", "cam", "camiseta azul", "produto", "xyz") # "" navega pelo catálogo
+
+
+async def bench_inline(args) -> None:
+    import vendas
+
+    vendas.setup_database()
+
+    async def answer(results, **kwargs) -> None:
+        pass # Só o handler: montar (ou reaproveitar) a resposta, sem a ida ao Telegram
+
+    context = SimpleNamespace(bot=SimpleNamespace(link="https://t.me/benchmark_bot"))
+
+    async def timed(term: str, miss: bool) -> float:
+        if miss:
+            vendas.inline_result_cache._entries.clear()
+        update = SimpleNamespace(inline_query=SimpleNamespace(query=term, offset="", answer=answer))
+        started = time.perf_counter()
+        await vendas.inline_query_handler(update, context)
+        return time.perf_counter() - started
+
+    print(f"\n{args.repeat} consultas por termo; tempos do inline_query_handler em ms\n")
+    print(f"{'produtos':>9}  {'termo':<16}{'miss p50':>10}{'miss p99':>10}{'hit p50':>10}{'hit p99':>10}{'ganho':>8}")
+    filled = 0
+    for size in sorted(args.sizes):
+        fill_sample_catalog(vendas, size - filled, start=filled)
+        filled = size
+        await vendas.catalog_cache.ensure_fresh() # Recarrega o catálogo fora da medição
+        for term in args.terms or INLINE_TERMS:
+            await timed(term, miss=True) # Aquece o cache de páginas do SQLite
+            misses = [await timed(term, miss=True) for _ in range(args.repeat)]
+            hits = [await timed(term, miss=False) for _ in range(args.repeat)]
+            miss_p50, hit_p50 = percentile(misses, 0.50), percentile(hits, 0.50)
+            print(f"{size:>9}  {repr(term):<16}{miss_p50 * 1000:>10.3f}{percentile(misses, 0.99) * 1000:>10.3f}"
+                  f"{hit_p50 * 1000:>10.3f}{percentile(hits, 0.99) * 1000:>10.3f}{miss_p50 / hit_p50:>7.0f}x")
+    vendas.get_db_pool().close()
+
+
+# --- Execução ---
+BENCHMARKS = {
+    "handlers": bench_handlers,
+    "persistence": bench_persistence,
+    "router": bench_router,
+    "catalog": bench_catalog,
+    "search": bench_search,
+    "inline": bench_inline,
+}
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Micro-benchmarks do bot de vendas (antes x depois).")
+    parser.add_argument("--database", default="loja_bot.db", help="Banco usado como base; o benchmark roda sobre uma cópia.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    handlers = subparsers.add_parser("handlers", help="Acesso a dados dos handlers: conexão por chamada x pool x cache.")
+    handlers.add_argument("--calls", type=int, default=5000, help="Quantos handlers simulados rodar (padrão: 5000).")
+    handlers.add_argument("--concurrency", type=int, default=100, help="Handlers ao mesmo tempo (padrão: 100).")
+    handlers.add_argument("--api-latency-ms", type=float, default=5, help="Espera simulada pelo Telegram em cada handler.")
+
+    persistence = subparsers.add_parser("persistence", help="Cliques por segundo com persistência das sessões x sem.")
+    persistence.add_argument("--users", type=int, default=500, help="Usuários simulados (padrão: 500).")
+    persistence.add_argument("--clicks", type=int, default=10, help="Cliques por usuário (padrão: 10).")
+    persistence.add_argument(
+        "--flush-interval", type=float, default=1,
+        help="PERSISTENCE_FLUSH_INTERVAL da rodada (padrão: 1s, para que as gravações em lote caiam dentro da medição).",
+    )
+    persistence.add_argument("--api-port", type=int, default=8765, help="Porta local da Bot API falsa.")
+
+    router = subparsers.add_parser("router", help="Custo de despachar um callback: cadeia if/elif x callback_router.")
+    router.add_argument("--iterations", type=int, default=200000, help="Despachos medidos por callback_data (padrão: 200000).")
+
+    catalog = subparsers.add_parser("catalog", help="Linhas/s da importação e exportação do catálogo (CSV e JSONL).")
+    catalog.add_argument("--rows", type=int, default=200000, help="Produtos no catálogo sintético (padrão: 200000).")
+
+    search = subparsers.add_parser("search", help="Tempo por busca num catálogo grande, com termos seletivos e amplos.")
+    search.add_argument("--rows", type=int, default=100000, help="Produtos sintéticos no catálogo (padrão: 100000).")
+    search.add_argument("--repeat", type=int, default=50, help="Buscas medidas por termo (padrão: 50).")
+    search.add_argument("--terms", nargs="+", help="Termos a medir (padrão: uma lista com termos seletivos e amplos).")
+
+    inline = subparsers.add_parser("inline", help="Latência do modo inline com o cache de respostas vazio x cheio.")
+    inline.add_argument(
+        "--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+        help="Tamanhos do catálogo sintético, medidos em ordem crescente (padrão: 1000 10000 100000).",
+    )
+    inline.add_argument("--repeat", type=int, default=50, help="Consultas medidas por termo, em cada caso (padrão: 50).")
+    inline.add_argument("--terms", nargs="+", help="Termos a medir (padrão: navegação sem termo e termos seletivos e amplos).")
+    return parser.parse_args(argv)
+
+
+def main() -> int:
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="loja_bench_")
+    database = os.path.join(workdir, "loja_bot.db")
+    if os.path.exists(args.database):
+        shutil.copy(args.database, database)
+    os.environ["TELEGRAM_BOT_TOKEN"] = FAKE_BOT_TOKEN
+    os.environ["DATABASE_FILE"] = database
+    try:
+        asyncio.run(BENCHMARKS[args.benchmark](args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
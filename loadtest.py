@@ -0,0 +1,722 @@
+"""Teste de carga offline do bot de vendas.
+
+Sobe um servidor falso da Bot API em um processo separado (ASGI + uvicorn, o
+mesmo esquema do modo webhook), aponta a `Application` de `vendas.py` para ele
+via `TELEGRAM_API_URL` e faz milhares de usuários simulados percorrerem os
+fluxos reais da loja ao mesmo tempo:
+
+    /start -> @bot <busca> -> show_products -> view_product_<ID> -> add_one_<ID>
+           -> checkout_cart -> show_donation -> donate_<centavos>
+
+Cada update passa pelo mesmo caminho da produção (processador de updates por
+usuário, handlers, pool do SQLite, rate limiter e persistência), só que contra
+uma cópia descartável do banco. No final mostra p50/p99 e updates por segundo
+de cada fluxo. Com o servidor falso em outro processo (e outro event loop), o
+custo do HTTP do lado do "Telegram" não entra na medição do bot.
+
+Com `--scenario outbound` a API falsa passa a impor os limites do Telegram
+(30 mensagens/s no total, 1/s por chat com rajada de 3) e responde 429 com
+`retry_after` como o real. Cada usuário manda /start e depois vários cliques que
+editam a mesma mensagem; o relatório mostra quantas mensagens por segundo foram
+de fato entregues, quantos 429 vieram e o que o rate limiter do bot fez.
+
+Uso:
+    python loadtest.py --users 2000
+    python loadtest.py --users 500 --api-latency-ms 40 --real-limits
+    python loadtest.py --json resultado.json --max-p99-ms 250   # como regressão
+    python loadtest.py --scenario outbound --users 100 --clicks 5
+    python loadtest.py --scenario stock --users 500 --stock 20
+
+O cenário `stock` deixa um único produto com estoque limitado e faz todos os
+usuários adicioná-lo e finalizar a compra ao mesmo tempo. Sai com código 1 se
+forem gravados mais (ou menos) pedidos do que o estoque permite, ou se o estoque
+final ficar negativo.
+
+O cenário `workers` roda o próprio `vendas.py` em modo webhook com
+`WORKERS=1..--workers`, envia os updates por HTTP ao webhook (reenviando quando
+ele responde 503, como o Telegram faz) e mede em quanto tempo todos foram
+respondidos na API falsa, para mostrar quanto cada worker a mais acrescenta:
+
+    python loadtest.py --scenario workers --workers 4 --users 500
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from itertools import cycle, islice
+from urllib.parse import parse_qs
+from urllib.request import urlopen
+
+FAKE_BOT_TOKEN = "123456:LOADTEST"
+FAKE_BOT_ID = 123456
+
+# Limites do Telegram impostos pela API falsa com --scenario outbound
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_CHAT_BURST = 3
+
+
+# --- Servidor falso da Bot API ---
+class FakeRateLimit:
+    """Token bucket do lado do "Telegram": recusa (em vez de enfileirar) quando não há token."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self) -> float:
+        """Quanto falta para haver um token (0 se houver)."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class FakeBotAPI:
+    """Aplicação ASGI que responde às chamadas da Bot API como o Telegram faria.
+
+    Não guarda estado: cada sendMessage/sendPhoto/edit* devolve uma mensagem
+    montada a partir dos parâmetros recebidos, e o resto devolve `true`.
+    `GET /stats` devolve quantas chamadas de cada método foram recebidas.
+
+    Com `enforce_limits`, os envios e edições (send*/edit*) passam por um
+    bucket global e um por chat; sem token, a resposta é 429 com `retry_after`.
+    As mensagens entregues e o intervalo em que chegaram também entram no `/stats`.
+    """
+
+    def __init__(self, latency: float = 0.0, enforce_limits: bool = False):
+        self.latency = latency
+        self.enforce_limits = enforce_limits
+        self.calls: dict = {}
+        self._message_ids = 0
+        self._global_limit = FakeRateLimit(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self._chat_limits: dict = {}
+        self.delivered = 0
+        self.rate_limited = 0
+        self._first_delivery = None
+        self._last_delivery = None
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        if scope["path"] == "/stats":
+            await self._send_json(send, self.stats())
+            return
+
+        endpoint = scope["path"].rsplit("/", 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if endpoint.startswith(("send", "edit")):
+            retry_after = self._check_limits(params.get("chat_id"))
+            if retry_after:
+                self.rate_limited += 1
+                await self._send_json(send, {
+                    "ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry_after}",
+                    "parameters": {"retry_after": retry_after},
+                }, status=429)
+                return
+            self.delivered += 1
+            self._last_delivery = time.monotonic()
+            if self._first_delivery is None:
+                self._first_delivery = self._last_delivery
+
+        await self._send_json(send, {"ok": True, "result": self._result(endpoint, params)})
+
+    def _check_limits(self, chat_id) -> int:
+        """Consome os tokens da chamada; devolve o `retry_after` (segundos inteiros) se ela estourou o limite."""
+        if not self.enforce_limits:
+            return 0
+        chat_limit = self._chat_limits.get(chat_id)
+        if chat_limit is None:
+            chat_limit = self._chat_limits[chat_id] = FakeRateLimit(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+        wait = max(self._global_limit.wait_time(), chat_limit.wait_time())
+        if wait:
+            return max(1, int(wait + 0.999))
+        self._global_limit.take()
+        chat_limit.take()
+        return 0
+
+    @staticmethod
+    async def _send_json(send, payload: dict, status: int = 200) -> None:
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": json.dumps(payload).encode()})
+
+    def stats(self) -> dict:
+        window = (self._last_delivery - self._first_delivery) if self.delivered > 1 else 0.0
+        return {"calls": self.calls, "delivered": self.delivered, "rate_limited": self.rate_limited, "delivery_seconds": window}
+
+    def _result(self, endpoint: str, params: dict):
+        if endpoint == "getMe":
+            return {
+                "id": FAKE_BOT_ID, "is_bot": True, "first_name": "Loja", "username": "loja_loadtest_bot",
+                "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": True,
+            }
+        if endpoint.startswith(("send", "edit")):
+            self._message_ids += 1
+            message = {
+                "message_id": int(params.get("message_id", self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "from": {"id": FAKE_BOT_ID, "is_bot": True, "first_name": "Loja"},
+            }
+            if endpoint == "sendPhoto":
+                file_id = f"fake-photo-{self._message_ids}"
+                message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 320, "height": 320}]
+                message["caption"] = params.get("caption", "")
+            else:
+                message["text"] = params.get("text", params.get("caption", ""))
+            return message
+        return True
+
+
+class FakeAPIProcess:
+    """Roda o `FakeBotAPI` em um subprocesso (`loadtest.py --serve-fake-api`) durante o bloco `with`."""
+
+    def __init__(self, port: int, latency_ms: float = 0, enforce_limits: bool = False):
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.command = [
+            sys.executable, os.path.abspath(__file__), "--serve-fake-api",
+            "--api-port", str(port), "--api-latency-ms", str(latency_ms),
+        ]
+        if enforce_limits:
+            self.command.append("--api-limits")
+        self.process = None
+
+    def __enter__(self) -> "FakeAPIProcess":
+        self.process = subprocess.Popen(self.command)
+        deadline = time.monotonic() + 15
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.2).close()
+                return self
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.__exit__(None, None, None)
+                    raise RuntimeError(f"A Bot API falsa não subiu na porta {self.port}.")
+                time.sleep(0.05)
+
+    def stats(self) -> dict:
+        with urlopen(f"{self.url}/stats", timeout=10) as response:
+            return json.load(response)
+
+    def __exit__(self, *exc) -> None:
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+def serve_fake_api(args) -> None:
+    import uvicorn
+
+    uvicorn.run(
+        FakeBotAPI(latency=args.api_latency_ms / 1000, enforce_limits=args.api_limits),
+        host="127.0.0.1", port=args.api_port, log_level="warning", lifespan="off",
+    )
+
+
+class BotProcess:
+    """Roda `vendas.py` em modo webhook, com `workers` processos, durante o bloco `with`."""
+
+    def __init__(self, workers: int, port: int, database: str, log_path: str):
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}/telegram"
+        self.secret = "loadtest-secret"
+        self.env = dict(
+            os.environ, WORKERS=str(workers), PORT=str(port), WEBHOOK_LISTEN="127.0.0.1", WEBHOOK_PATH="/telegram",
+            WEBHOOK_URL="https://loadtest.invalid", WEBHOOK_SECRET=self.secret, DATABASE_FILE=database,
+            METRICS_ENABLED="false",
+        )
+        self.log_path = log_path
+        self.process = None
+
+    def __enter__(self) -> "BotProcess":
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vendas.py")
+        with open(self.log_path, "ab") as log:
+            self.process = subprocess.Popen([sys.executable, script], env=self.env, stdout=log, stderr=log)
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.2).close()
+                return self
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.__exit__(None, None, None)
+                    raise RuntimeError(f"O bot não subiu na porta {self.port}; veja {self.log_path}.")
+                time.sleep(0.1)
+
+    def __exit__(self, *exc) -> None:
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+# --- Usuários simulados ---
+def user_payload(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"Cliente{user_id}"}
+
+def command_update(update_id: int, user_id: int, text: str) -> dict:
+    command = text.split()[0]
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user_payload(user_id),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }
+
+def callback_update(update_id: int, user_id: int, data: str, message_id: int = None) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user_payload(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id or update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": FAKE_BOT_ID, "is_bot": True, "first_name": "Loja"},
+                "text": "...",
+            },
+        },
+    }
+
+def inline_update(update_id: int, user_id: int, query: str) -> dict:
+    return {
+        "update_id": update_id,
+        "inline_query": {"id": str(update_id), "from": user_payload(user_id), "query": query, "offset": ""},
+    }
+
+def flow_for(user_id: int, product_ids: list, queries: list) -> list:
+    """Sequência de (nome do fluxo, tipo, conteúdo) que um usuário percorre."""
+    product_id = product_ids[user_id % len(product_ids)]
+    donation = (500, 1000, 2500, 5000)[user_id % 4]
+    return [
+        ("/start", "command", "/start"),
+        ("inline_query", "inline", queries[user_id % len(queries)]),
+        ("show_products", "callback", "show_products"),
+        ("view_product_", "callback", f"view_product_{product_id}"),
+        ("add_one_", "callback", f"add_one_{product_id}"),
+        ("checkout_cart", "callback", "checkout_cart"),
+        ("show_donation", "callback", "show_donation"),
+        ("donate_", "callback", f"donate_{donation}"),
+    ]
+
+def stock_flow(product_id: int) -> list:
+    return [("add_one_", "callback", f"add_one_{product_id}"), ("checkout_cart", "callback", "checkout_cart")]
+
+def outbound_flow(clicks: int) -> list:
+    """/start e depois `clicks` cliques que editam a mesma mensagem (menu de produtos e carrinho)."""
+    return [("/start", "command", "/start")] + [
+        (data, "callback", data) for data in islice(cycle(("show_products", "show_cart")), clicks)
+    ]
+
+
+async def run_user(vendas, application, user_id: int, steps: list, think_time: float, latencies: dict, update_ids,
+                   message_id: int = None) -> None:
+    for flow, kind, content in steps:
+        update_id = next(update_ids)
+        if kind == "command":
+            data = command_update(update_id, user_id, content)
+        elif kind == "inline":
+            data = inline_update(update_id, user_id, content)
+        else:
+            data = callback_update(update_id, user_id, content, message_id)
+        update = vendas.Update.de_json(data, application.bot)
+        started = time.perf_counter()
+        # Mesmo caminho do fetcher da Application: processador de updates -> handlers
+        await application.update_processor.process_update(update, application.process_update(update))
+        latencies.setdefault(flow, []).append(time.perf_counter() - started)
+        if think_time:
+            await asyncio.sleep(think_time)
+
+
+async def post_user_updates(client, bot: BotProcess, updates: list, latencies: list) -> int:
+    """Entrega os updates de um usuário ao webhook, em ordem; devolve quantos 503 recebeu."""
+    rejected = 0
+    headers = {"X-Telegram-Bot-Api-Secret-Token": bot.secret, "Content-Type": "application/json"}
+    for data in updates:
+        body = json.dumps(data)
+        started = time.perf_counter()
+        while (await client.post(bot.url, content=body, headers=headers)).status_code == 503:
+            rejected += 1 # Fila cheia: o Telegram esperaria e reenviaria o mesmo update
+            await asyncio.sleep(0.05)
+        latencies.append(time.perf_counter() - started)
+    return rejected
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def latency_report(latencies: dict, elapsed: float) -> dict:
+    return {
+        flow: {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+            "mean_ms": round(statistics.fmean(values) * 1000, 2),
+            "updates_per_second": round(len(values) / elapsed, 1),
+        }
+        for flow, values in latencies.items()
+    }
+
+
+def inline_queries(vendas) -> list:
+    # Buscas inline como as de quem está digitando: prefixos dos nomes (e a vazia, que navega pelo catálogo)
+    return [""] + sorted({
+        word[:length].lower() for product in vendas.catalog_cache.all()
+        for word in product["nome"].split()[:1] for length in (3, len(word))
+    })
+
+
+def prepare_store(vendas) -> list:
+    """Cria o banco de teste com estoque ilimitado e devolve os IDs dos produtos."""
+    vendas.setup_database()
+    conn = sqlite3.connect(vendas.DATABASE_FILE)
+    with conn:
+        # Estoque ilimitado para que o checkout exercite sempre o caminho completo do pedido
+        conn.execute("UPDATE products SET estoque = NULL")
+    conn.close()
+    vendas.catalog_cache.load()
+    return [product["id"] for product in vendas.catalog_cache.all()]
+
+
+async def run_load(args, fake_api: FakeAPIProcess) -> dict:
+    import vendas # Importado só aqui: as variáveis de ambiente já apontam para o banco e a API falsos
+
+    product_ids = prepare_store(vendas)
+    queries = inline_queries(vendas)
+
+    application = vendas.build_application()
+    latencies: dict = {}
+    update_ids = iter(range(1, 1 << 62))
+    async with application:
+        await application.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            run_user(vendas, application, user_id, flow_for(user_id, product_ids, queries), args.think_time_ms / 1000,
+                     latencies, update_ids)
+            for user_id in range(1000, 1000 + args.users)
+        ))
+        elapsed = time.perf_counter() - started
+        processor_stats = application.update_processor.stats()
+        await application.stop()
+
+    total_updates = sum(len(values) for values in latencies.values())
+    return {
+        "users": args.users,
+        "elapsed_seconds": round(elapsed, 3),
+        "updates_per_second": round(total_updates / elapsed, 1),
+        "api_calls": fake_api.stats()["calls"],
+        # Quanto da latência foi fila (esperando vaga no processador) e não trabalho do bot
+        "queue_wait_ms": {"avg": round(processor_stats["avg_wait_ms"], 2), "max": round(processor_stats["max_wait_ms"], 2)},
+        "flows": latency_report(latencies, elapsed),
+    }
+
+
+async def run_stock(args, fake_api: FakeAPIProcess) -> dict:
+    """Vários usuários disputando o mesmo produto de estoque limitado: nunca pode vender além do estoque."""
+    import vendas
+
+    product_id = prepare_store(vendas)[0]
+    conn = sqlite3.connect(vendas.DATABASE_FILE)
+    with conn:
+        conn.execute("UPDATE products SET estoque = ? WHERE id = ?", (args.stock, product_id))
+    conn.close()
+    vendas.catalog_cache.load()
+
+    application = vendas.build_application()
+    latencies: dict = {}
+    update_ids = iter(range(1, 1 << 62))
+    async with application:
+        await application.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            run_user(vendas, application, user_id, stock_flow(product_id), args.think_time_ms / 1000, latencies, update_ids)
+            for user_id in range(1000, 1000 + args.users)
+        ))
+        elapsed = time.perf_counter() - started
+        await application.stop()
+
+    conn = sqlite3.connect(vendas.DATABASE_FILE)
+    orders, units_sold = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(quantity), 0) FROM order_items WHERE product_id = ?", (product_id,)
+    ).fetchone()
+    final_stock = conn.execute("SELECT estoque FROM products WHERE id = ?", (product_id,)).fetchone()[0]
+    conn.close()
+
+    expected = min(args.users, args.stock)
+    total_updates = sum(len(values) for values in latencies.values())
+    return {
+        "scenario": "stock",
+        "users": args.users,
+        "elapsed_seconds": round(elapsed, 3),
+        "updates_per_second": round(total_updates / elapsed, 1),
+        "stock": {"initial": args.stock, "orders": orders, "units_sold": units_sold, "final": final_stock},
+        "ok": orders == expected and units_sold == expected and final_stock == args.stock - units_sold and final_stock >= 0,
+        "api_calls": fake_api.stats()["calls"],
+        "flows": latency_report(latencies, elapsed),
+    }
+
+
+async def run_outbound(args, fake_api: FakeAPIProcess) -> dict:
+    """Mede mensagens entregues por segundo contra a API falsa com os limites do Telegram."""
+    import vendas
+
+    prepare_store(vendas)
+    application = vendas.build_application()
+    latencies: dict = {}
+    update_ids = iter(range(1, 1 << 62))
+    async with application:
+        await application.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            # Todos os cliques do usuário editam a mesma mensagem (message_id fixo por chat)
+            run_user(vendas, application, user_id, outbound_flow(args.clicks), args.think_time_ms / 1000, latencies,
+                     update_ids, message_id=user_id)
+            for user_id in range(1000, 1000 + args.users)
+        ))
+        elapsed = time.perf_counter() - started
+        limiter_stats = application.bot.rate_limiter.stats()
+        await application.stop()
+
+    api_stats = fake_api.stats()
+    window = api_stats["delivery_seconds"] or elapsed
+    total_updates = sum(len(values) for values in latencies.values())
+    return {
+        "scenario": "outbound",
+        "users": args.users,
+        "elapsed_seconds": round(elapsed, 3),
+        "updates_per_second": round(total_updates / elapsed, 1),
+        "delivered": api_stats["delivered"],
+        "delivered_per_second": round(api_stats["delivered"] / window, 1),
+        "rate_limited": api_stats["rate_limited"],
+        "limiter": limiter_stats,
+        "api_calls": api_stats["calls"],
+        "flows": latency_report(latencies, elapsed),
+    }
+
+
+def answered_updates(calls: dict) -> int:
+    """Updates já respondidos: cada callback e cada busca inline do fluxo geram exatamente uma resposta."""
+    return calls.get("answerCallbackQuery", 0) + calls.get("answerInlineQuery", 0)
+
+
+def run_worker_scaling(args, fake_api: FakeAPIProcess) -> dict:
+    """Mede updates/s do `vendas.py` real em modo webhook com 1..`--workers` workers."""
+    import httpx
+    import vendas
+
+    product_ids = prepare_store(vendas)
+    queries = inline_queries(vendas)
+    workdir = os.path.dirname(vendas.DATABASE_FILE)
+    # Sem o /start: todo o resto do fluxo responde exatamente uma vez (answerCallbackQuery/answerInlineQuery)
+    steps_by_user = {
+        user_id: flow_for(user_id, product_ids, queries)[1:] for user_id in range(1000, 1000 + args.users)
+    }
+
+    async def deliver(bot: BotProcess) -> dict:
+        update_ids = iter(range(1, 1 << 62))
+        updates_by_user = [
+            [
+                inline_update(next(update_ids), user_id, content) if kind == "inline"
+                else callback_update(next(update_ids), user_id, content)
+                for _, kind, content in steps
+            ]
+            for user_id, steps in steps_by_user.items()
+        ]
+        expected = answered_updates(fake_api.stats()["calls"]) + sum(len(updates) for updates in updates_by_user)
+        latencies: list = []
+        # 40 conexões simultâneas, como o Telegram (padrão do `max_connections` do setWebhook)
+        limits = httpx.Limits(max_connections=40, max_keepalive_connections=40)
+        async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+            started = time.perf_counter()
+            rejected = sum(await asyncio.gather(*(
+                post_user_updates(client, bot, updates, latencies) for updates in updates_by_user
+            )))
+            deadline = time.monotonic() + 300
+            while answered_updates(fake_api.stats()["calls"]) < expected:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("Nem todos os updates foram respondidos em 5 minutos.")
+                await asyncio.sleep(0.05)
+            elapsed = time.perf_counter() - started
+        return {
+            "updates": len(latencies),
+            "elapsed_seconds": round(elapsed, 3),
+            "updates_per_second": round(len(latencies) / elapsed, 1),
+            "webhook_503": rejected,
+            "webhook_p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        }
+
+    runs = {}
+    for workers in range(1, args.workers + 1):
+        # Cada rodada começa de uma cópia limpa do banco preparado
+        database = os.path.join(workdir, f"workers_{workers}.db")
+        with sqlite3.connect(vendas.DATABASE_FILE) as source, sqlite3.connect(database) as target:
+            source.backup(target)
+        with BotProcess(workers, args.webhook_port, database, os.path.join(workdir, f"workers_{workers}.log")) as bot:
+            runs[workers] = asyncio.run(deliver(bot))
+        runs[workers]["speedup"] = round(runs[workers]["updates_per_second"] / runs[1]["updates_per_second"], 2)
+
+    return {"scenario": "workers", "users": args.users, "cpus": os.cpu_count(), "workers": runs}
+
+
+def print_workers_report(result: dict) -> None:
+    print(f"\n{result['users']} usuários, {result['cpus']} CPUs\n")
+    print(f"{'workers':<9}{'updates':>9}{'tempo (s)':>11}{'updates/s':>11}{'ganho':>8}{'503':>7}{'p99 entrega (ms)':>18}")
+    for workers, run in result["workers"].items():
+        print(f"{workers:<9}{run['updates']:>9}{run['elapsed_seconds']:>11}{run['updates_per_second']:>11}"
+              f"{run['speedup']:>7}x{run['webhook_503']:>7}{run['webhook_p99_ms']:>18}")
+    if result["cpus"] and result["cpus"] < len(result["workers"]):
+        print(f"\nAtenção: só {result['cpus']} CPU(s) nesta máquina; workers além disso disputam o mesmo núcleo.")
+
+
+def print_report(result: dict) -> None:
+    print(f"\n{result['users']} usuários, {result['elapsed_seconds']}s, {result['updates_per_second']} updates/s no total\n")
+    print(f"{'fluxo':<16}{'updates':>9}{'p50 (ms)':>11}{'p99 (ms)':>11}{'média (ms)':>12}{'updates/s':>11}")
+    for flow, stats in result["flows"].items():
+        print(f"{flow:<16}{stats['count']:>9}{stats['p50_ms']:>11}{stats['p99_ms']:>11}{stats['mean_ms']:>12}{stats['updates_per_second']:>11}")
+    if "queue_wait_ms" in result:
+        print(f"\nEspera na fila do processador: média {result['queue_wait_ms']['avg']} ms, máx. {result['queue_wait_ms']['max']} ms")
+    if "stock" in result:
+        stock = result["stock"]
+        print(f"\nEstoque: {stock['initial']} iniciais, {stock['orders']} pedidos, {stock['units_sold']} unidades vendidas, "
+              f"{stock['final']} no final")
+    if "delivered" in result:
+        limiter = result["limiter"]
+        print(f"\nMensagens entregues: {result['delivered']} ({result['delivered_per_second']}/s; limite global {TELEGRAM_GLOBAL_RATE}/s)")
+        print(f"Respostas 429: {result['rate_limited']}")
+        print(f"Rate limiter: {limiter['sent']} enviadas, {limiter['coalesced']} edições juntadas, {limiter['retried']} reenvios")
+    print(f"Chamadas à API falsa: {result['api_calls']}")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Teste de carga offline do bot de vendas contra uma Bot API falsa.")
+    parser.add_argument(
+        "--scenario", choices=("flows", "outbound", "stock", "workers"), default="flows",
+        help="flows: percorre os fluxos da loja (padrão); outbound: mede entregas por segundo com os limites do "
+             "Telegram; stock: disputa concorrente pelo estoque de um produto; workers: ganho de 1 a --workers "
+             "processos no modo webhook.",
+    )
+    parser.add_argument("--users", type=int, default=1000, help="Quantidade de usuários simulados (padrão: 1000).")
+    parser.add_argument("--think-time-ms", type=float, default=0, help="Pausa de cada usuário entre uma ação e outra.")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="Latência simulada de cada chamada à Bot API.")
+    parser.add_argument("--clicks", type=int, default=5, help="Cliques por usuário no cenário outbound (padrão: 5).")
+    parser.add_argument("--stock", type=int, default=20, help="Estoque do produto disputado no cenário stock (padrão: 20).")
+    parser.add_argument("--workers", type=int, default=4, help="Máximo de workers no cenário workers (padrão: 4).")
+    parser.add_argument("--webhook-port", type=int, default=8766, help="Porta local do webhook no cenário workers.")
+    parser.add_argument("--api-port", type=int, default=8765, help="Porta local do servidor falso da Bot API.")
+    parser.add_argument("--database", default="loja_bot.db", help="Banco usado como base; o teste roda sobre uma cópia.")
+    parser.add_argument(
+        "--real-limits", action="store_true",
+        help="Mantém os limites de envio do Telegram (OUTBOUND_*). Por padrão eles são removidos para medir só o bot "
+             "(o cenário outbound sempre os mantém).",
+    )
+    parser.add_argument("--json", metavar="ARQUIVO", help="Grava o resultado em JSON (para comparar entre versões).")
+    parser.add_argument("--max-p99-ms", type=float, help=(
+        "Sai com código 1 se o p99 de algum fluxo passar deste valor "
+        "(em --scenario workers, o p99 da entrega ao webhook)."
+    ))
+    parser.add_argument("--serve-fake-api", action="store_true", help=argparse.SUPPRESS) # Modo do subprocesso
+    parser.add_argument("--api-limits", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main() -> int:
+    args = parse_args()
+    if args.serve_fake_api:
+        serve_fake_api(args)
+        return 0
+
+    workdir = tempfile.mkdtemp(prefix="loja_loadtest_")
+    database = os.path.join(workdir, "loja_bot.db")
+    if os.path.exists(args.database):
+        shutil.copy(args.database, database)
+
+    os.environ["TELEGRAM_BOT_TOKEN"] = FAKE_BOT_TOKEN
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{args.api_port}"
+    os.environ["DATABASE_FILE"] = database
+    os.environ["BOT_MODE"] = "webhook" # Sem Updater: os updates são entregues direto ao processador
+    outbound = args.scenario == "outbound"
+    if not args.real_limits and not outbound:
+        for name, value in (("OUTBOUND_GLOBAL_RATE", "1000000"), ("OUTBOUND_CHAT_RATE", "1000000"), ("OUTBOUND_CHAT_BURST", "1000000")):
+            os.environ.setdefault(name, value)
+
+    try:
+        with FakeAPIProcess(args.api_port, args.api_latency_ms, enforce_limits=outbound) as fake_api:
+            if args.scenario == "workers":
+                result = run_worker_scaling(args, fake_api)
+            else:
+                scenario = {"flows": run_load, "outbound": run_outbound, "stock": run_stock}[args.scenario]
+                result = asyncio.run(scenario(args, fake_api))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.scenario == "workers":
+        print_workers_report(result)
+    else:
+        print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as handle:
+            json.dump(result, handle, indent=2, ensure_ascii=False)
+
+    if result.get("ok") is False:
+        print(f"\nFALHOU: o estoque não confere com os pedidos gravados ({result['stock']})")
+        return 1
+    if args.max_p99_ms is not None:
+        if args.scenario == "workers":
+            # Aqui a latência medida é a da entrega ao webhook, uma por quantidade de workers
+            slow = [f"{workers} workers" for workers, run in result["workers"].items() if run["webhook_p99_ms"] > args.max_p99_ms]
+        else:
+            slow = [flow for flow, stats in result["flows"].items() if stats["p99_ms"] > args.max_p99_ms]
+        if slow:
+            print(f"\nFALHOU: p99 acima de {args.max_p99_ms} ms em {', '.join(slow)}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,79 +1,1643 @@
+import time
+_IMPORTS_STARTED_AT = time.perf_counter() # Para o --profile-startup
+
+import argparse
+import asyncio
+import bisect
+import contextvars
+import hashlib
+import hmac
+import json
 import logging
+import multiprocessing
+import pickle
+import queue
+import re
+import secrets
+import signal
 import sqlite3
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters
+import sys
+import threading
+import unicodedata
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.helpers import escape_markdown
+from telegram.ext import Application, BasePersistence, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, PersistenceInput, ContextTypes, CallbackQueryHandler, InlineQueryHandler, MessageHandler, TypeHandler, filters
 import os
 from dotenv import load_dotenv
-from typing import Optional
+from itertools import islice
+from typing import Iterator, NamedTuple, Optional
+
+IMPORT_SECONDS = time.perf_counter() - _IMPORTS_STARTED_AT
 
 # Carrega variáveis de ambiente, se existir o arquivo .env
 load_dotenv()
 
 # --- Configurações ---
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-DATABASE_FILE = "loja_bot.db"
+# Servidor da Bot API (ex: um telegram-bot-api local ou o servidor falso do loadtest.py)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+DATABASE_FILE = os.getenv("DATABASE_FILE", "loja_bot.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_BUSY_TIMEOUT_MS = 5000 # Quanto uma conexão do pool espera por uma trava antes de desistir
+CATALOG_TTL_SECONDS = float(os.getenv("CATALOG_TTL_SECONDS", "300"))
+# A cada quantos segundos cada processo confere no banco se o catálogo foi alterado
+CATALOG_POLL_SECONDS = float(os.getenv("CATALOG_POLL_SECONDS", "2"))
+PRODUCTS_PAGE_SIZE = int(os.getenv("PRODUCTS_PAGE_SIZE", "10"))
+# Memória máxima (aproximada, em bytes) para os cards de produto já renderizados
+RENDER_CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_BYTES", str(4 * 1024 * 1024)))
+# Modo inline: por quantos segundos o Telegram (cache_time) e o próprio bot guardam a resposta de uma busca
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "60"))
+INLINE_RESULT_CACHE_SECONDS = float(os.getenv("INLINE_RESULT_CACHE_SECONDS", "30"))
+
+# Modo de recebimento de updates: "polling" (padrão) ou "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # URL pública, ex: https://meubot.up.railway.app
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+# Processos que dividem os updates do webhook entre si, por usuário (1 = processo único)
+WORKERS = max(1, int(os.getenv("WORKERS", "1")))
+WORKER_CHECK_SECONDS = 1 # De quanto em quanto tempo o receptor confere se algum worker morreu
+
+# Quantos updates são processados ao mesmo tempo (updates do mesmo usuário continuam em ordem)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+
+# Limites de envio para a API do Telegram (mensagens por segundo)
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+
+# Intervalo (segundos) entre as gravações em lote das sessões (carrinhos) no SQLite
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", "10"))
+
+# Por quantos segundos um item no carrinho fica reservado para o usuário (0 = sem reserva)
+CART_HOLD_SECONDS = float(os.getenv("CART_HOLD_SECONDS", "0"))
+
+# Tarefas em segundo plano (JobQueue). Sessão ociosa por mais de SESSION_TTL_SECONDS
+# é descartada com o carrinho (0 = nunca); o lembrete de carrinho abandonado sai
+# depois de CART_REMINDER_SECONDS sem atividade (0 = sem lembretes)
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", str(24 * 3600)))
+SESSION_SWEEP_SECONDS = float(os.getenv("SESSION_SWEEP_SECONDS", "300"))
+CART_REMINDER_SECONDS = float(os.getenv("CART_REMINDER_SECONDS", "3600"))
+CART_REMINDER_BATCH = int(os.getenv("CART_REMINDER_BATCH", "50"))
+DB_MAINTENANCE_SECONDS = float(os.getenv("DB_MAINTENANCE_SECONDS", "3600"))
+
+# Métricas no formato Prometheus (desligadas por padrão; sem custo quando desligadas)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() in ("1", "true", "yes")
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1") # Endpoint local: nunca na porta pública do webhook
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# Fuso usado para separar os dias nos relatórios (padrão: horário de Brasília)
+REPORT_UTC_OFFSET_HOURS = float(os.getenv("REPORT_UTC_OFFSET_HOURS", "-3"))
+
+# IDs de usuários com acesso aos comandos administrativos, separados por vírgula
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+
+# Só pedimos ao Telegram os tipos de update que o bot realmente trata
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.INLINE_QUERY]
 
 # Configuração de logging básico
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("apscheduler").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
+# --- Métricas ---
+class Counter:
+    """Contador Prometheus com rótulos."""
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name, self.help_text, self.labels = name, help_text, labels
+        self.values: dict = {}
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    """Histograma Prometheus com rótulos e buckets fixos."""
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name, self.help_text, self.labels, self.buckets = name, help_text, labels, buckets
+        self.values: dict = {} # rótulos -> [contagens por bucket..., soma, total]
+
+    def observe(self, value: float, *label_values) -> None:
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets): # acima do último bucket só conta no +Inf
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels + ('le',), label_values + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels + ('le',), label_values + ('+Inf',))} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {series[-1]}")
+        return lines
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+
+HANDLER_LATENCY = Histogram("bot_handler_latency_seconds", "Tempo de execução de cada handler.", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Exceções que escaparam de um handler.", ("handler",))
+SWALLOWED_ERRORS = Counter("bot_swallowed_errors_total", "Exceções capturadas e ignoradas (ex: answer() de query expirada).", ("where",))
+DB_CALL_LATENCY = Histogram("bot_db_call_latency_seconds", "Tempo de cada função de banco executada no pool.", ("function",))
+SQL_QUERIES_PER_UPDATE = Histogram("bot_sql_queries_per_update", "Comandos SQL executados por update.", ("handler",), buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100))
+TELEGRAM_API_LATENCY = Histogram("bot_telegram_api_latency_seconds", "Latência das chamadas à API do Telegram.", ("endpoint",))
+JOB_LATENCY = Histogram("bot_job_latency_seconds", "Duração de cada execução das tarefas em segundo plano.", ("job",))
+JOB_ITEMS = Counter("bot_job_items_total", "Itens tratados pelas tarefas em segundo plano (sessões descartadas, lembretes enviados).", ("job",))
+ALL_METRICS = (
+    HANDLER_LATENCY, HANDLER_ERRORS, SWALLOWED_ERRORS, DB_CALL_LATENCY, SQL_QUERIES_PER_UPDATE, TELEGRAM_API_LATENCY,
+    JOB_LATENCY, JOB_ITEMS,
+)
+
+# Contador de comandos SQL do update em andamento (uma lista de 1 elemento, mutável entre threads)
+_sql_query_counter: contextvars.ContextVar = contextvars.ContextVar("sql_query_counter", default=None)
+
+def render_metrics() -> str:
+    lines = []
+    for metric in ALL_METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def record_swallowed_error(where: str) -> None:
+    """Contabiliza uma exceção que foi capturada e ignorada de propósito."""
+    if METRICS_ENABLED:
+        SWALLOWED_ERRORS.inc(where)
+
+def _count_sql_statement(statement: str) -> None:
+    counter = _sql_query_counter.get()
+    if counter is not None:
+        counter[0] += 1
+
+def instrument_handler(callback, name: Optional[str] = None):
+    """Envolve um handler medindo latência, erros e comandos SQL por update.
+
+    Com as métricas desligadas devolve o próprio handler, sem nenhum custo extra.
+    """
+    if not METRICS_ENABLED:
+        return callback
+    name = name or callback.__name__
+
+    async def instrumented(update, context, *args, **kwargs):
+        counter = [0]
+        token = _sql_query_counter.set(counter)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context, *args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, name)
+            SQL_QUERIES_PER_UPDATE.observe(counter[0], name)
+            _sql_query_counter.reset(token)
+
+    instrumented.__name__ = callback.__name__
+    return instrumented
+
+def instrument_job(callback):
+    """Como `instrument_handler`, para callbacks da JobQueue (que recebem só o contexto)."""
+    if not METRICS_ENABLED:
+        return callback
+
+    async def instrumented(context):
+        started = time.perf_counter()
+        try:
+            return await callback(context)
+        finally:
+            JOB_LATENCY.observe(time.perf_counter() - started, callback.__name__)
+
+    instrumented.__name__ = callback.__name__
+    return instrumented
+
+async def _serve_metrics_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        if request_line.split(b" ")[1:2] == [b"/metrics"]:
+            body, status = render_metrics().encode(), b"200 OK"
+        else:
+            body, status = b"", b"404 Not Found"
+        writer.write(
+            b"HTTP/1.1 " + status + b"\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def start_metrics_server() -> Optional[asyncio.AbstractServer]:
+    """Sobe o endpoint HTTP `/metrics` local, se as métricas estiverem ligadas."""
+    if not METRICS_ENABLED:
+        return None
+    server = await asyncio.start_server(_serve_metrics_connection, METRICS_LISTEN, METRICS_PORT)
+    logger.info(f"Métricas disponíveis em http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+    return server
+
+# --- Pool de Conexões ---
+class ConnectionPool:
+    """Pool pequeno de conexões SQLite de longa duração, usadas fora do event loop.
+
+    Cada conexão fica aberta durante toda a vida do processo (modo WAL), o que
+    permite ao sqlite3 reaproveitar os statements já preparados. As consultas
+    rodam em um ThreadPoolExecutor com o mesmo número de threads que conexões.
+    """
+
+    def __init__(self, database: str, size: int = DB_POOL_SIZE):
+        self.database = database
+        self.size = max(1, size)
+        self._connections = queue.Queue()
+        self._opened = 0 # As conexões são abertas sob demanda, até `size`
+        self._open_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="db")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.database, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        if METRICS_ENABLED:
+            conn.set_trace_callback(_count_sql_statement)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Empresta uma conexão do pool (bloqueante; use dentro do executor)."""
+        try:
+            conn = self._connections.get_nowait()
+        except queue.Empty:
+            with self._open_lock:
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+            if not can_open:
+                conn = self._connections.get()
+            else:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._open_lock:
+                        self._opened -= 1
+                    raise
+        try:
+            yield conn
+        finally:
+            self._connections.put(conn)
+
+    async def run(self, func, *args):
+        """Executa `func(*args)` em uma thread do pool sem bloquear o event loop."""
+        loop = asyncio.get_running_loop()
+        if not METRICS_ENABLED:
+            return await loop.run_in_executor(self._executor, func, *args)
+        # Propaga o contador de SQL do update atual para a thread do pool
+        context = contextvars.copy_context()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, context.run, func, *args)
+        finally:
+            DB_CALL_LATENCY.observe(time.perf_counter() - started, func.__name__)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        while not self._connections.empty():
+            self._connections.get_nowait().close()
+
+
+_db_pool: Optional[ConnectionPool] = None
+
+def get_db_pool() -> ConnectionPool:
+    """Retorna o pool global, criando-o no primeiro uso."""
+    global _db_pool
+    if _db_pool is None:
+        _db_pool = ConnectionPool(DATABASE_FILE, DB_POOL_SIZE)
+    return _db_pool
+
+# --- Dinheiro ---
+class Money(int):
+    """Valor em centavos.
+
+    É um `int`: somas, multiplicações e comparações continuam exatas e tão
+    baratas quanto as de inteiros. Só a conversão de/para texto passa por
+    `Decimal`, nunca por float.
+    """
+
+    __slots__ = ()
+
+    MAX_CENTS = 10**12 # R$ 10 bilhões: bem longe do limite dos inteiros do SQLite, mesmo somando muitos valores
+
+    @classmethod
+    def parse(cls, value) -> "Money":
+        """Converte reais ('19,99', '19.99', 'R$ 5', 19.99) em centavos, arredondando meio centavo para cima.
+
+        Só aceita dígitos com um separador decimal opcional: notação científica ('1e30'),
+        infinito e valores acima de `MAX_CENTS` levantam `ValueError`.
+        """
+        text = str(value).strip().upper().removeprefix("R$").strip().replace(",", ".")
+        if not re.fullmatch(r"[+-]?(\d+(\.\d*)?|\.\d+)", text):
+            raise ValueError(f"valor inválido: {value!r}")
+        cents = (Decimal(text) * 100).to_integral_value(rounding=ROUND_HALF_UP)
+        if abs(cents) > cls.MAX_CENTS:
+            raise ValueError(f"valor fora do limite: {value!r}")
+        return cls(cents)
+
+    def to_decimal(self) -> Decimal:
+        """Valor em reais, como `Decimal` exato (ex: Decimal('19.99'))."""
+        return Decimal(int(self)).scaleb(-2)
+
+    def __str__(self) -> str:
+        sign = "-" if self < 0 else ""
+        cents = abs(int(self))
+        return f"R$ {sign}{cents // 100}.{cents % 100:02d}"
+
+    def __format__(self, spec: str) -> str:
+        return str(self) if not spec else int(self).__format__(spec)
+
+    def __repr__(self) -> str:
+        return f"Money({int(self)})"
+
 # --- Funções do Banco de Dados ---
-def initialize_database():
-    """Cria a tabela de produtos no banco de dados se ela não existir."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS products (
+def _ensure_column(conn: sqlite3.Connection, table: str, column: str, definition: str) -> bool:
+    """Adiciona uma coluna a uma tabela existente, se ela ainda não existir (migração simples).
+
+    Retorna True se a coluna foi criada agora.
+    """
+    columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column in columns:
+        return False
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    logger.info(f"Coluna {table}.{column} adicionada.")
+    return True
+
+# Versão do esquema gravada em `PRAGMA user_version`; incremente ao mudar `_create_schema`
+SCHEMA_VERSION = 4
+
+def _ensure_schema(conn: sqlite3.Connection) -> None:
+    """Cria/migra o esquema, a menos que o banco já esteja na versão atual.
+
+    No caso comum (banco já criado) custa uma única leitura de `PRAGMA user_version`.
+    """
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return
+    conn.execute("BEGIN IMMEDIATE") # Outro processo pode estar migrando ao mesmo tempo
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            _create_schema(conn)
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            logger.info("Banco de dados verificado/criado.")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+def _create_products_table(conn: sqlite3.Connection, name: str = "products") -> None:
+    # estoque NULL significa produto sem controle de estoque; o SKU identifica o produto nas importações
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {name} (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         nome TEXT NOT NULL,
-        preco REAL NOT NULL,
+        preco_centavos INTEGER NOT NULL,
         descricao TEXT,
-        imagem TEXT
+        imagem TEXT,
+        estoque INTEGER,
+        sku TEXT
+    )
+    """)
+
+def _migrate_prices_to_cents(conn: sqlite3.Connection) -> None:
+    """Reconstrói `products` trocando `preco REAL` (reais) por `preco_centavos INTEGER`.
+
+    O SQLite não altera o tipo de uma coluna, então a tabela é recriada e os
+    dados copiados com os mesmos IDs (o índice de busca e os file_id continuam
+    valendo). Os índices e triggers de `products` somem com a tabela antiga e são
+    recriados pelo restante de `_create_schema`.
+    """
+    sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'products'").fetchone()
+    _create_products_table(conn, "products_new")
+    conn.execute(
+        "INSERT INTO products_new (id, nome, preco_centavos, descricao, imagem, estoque, sku) "
+        "SELECT id, nome, CAST(ROUND(preco * 100) AS INTEGER), descricao, imagem, estoque, sku FROM products"
+    )
+    conn.execute("DROP TABLE products")
+    conn.execute("ALTER TABLE products_new RENAME TO products")
+    if sequence: # Mantém o AUTOINCREMENT: IDs de produtos apagados não são reutilizados
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'products'", (sequence[0],))
+    logger.info("Preços dos produtos migrados para centavos (products.preco_centavos).")
+
+def _create_schema(conn: sqlite3.Connection) -> None:
+    """Cria as tabelas, índices e triggers que ainda não existirem."""
+    _create_products_table(conn)
+    # Bancos antigos: colunas adicionadas depois da primeira versão
+    _ensure_column(conn, "products", "estoque", "INTEGER")
+    if _ensure_column(conn, "products", "sku", "TEXT"):
+        conn.execute("UPDATE products SET sku = 'PROD-' || id WHERE sku IS NULL")
+    if "preco" in {row["name"] for row in conn.execute("PRAGMA table_info(products)")}:
+        _migrate_prices_to_cents(conn)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_products_sku ON products (sku)")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS product_images (
+        product_id INTEGER PRIMARY KEY,
+        image_hash TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        updated_at REAL NOT NULL
     )
     """)
-    conn.commit()
-    conn.close()
-    logger.info("Banco de dados verificado/criado.")
+    # O file_id deixa de valer quando a imagem do produto muda (ou o produto some)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS product_image_changed AFTER UPDATE OF imagem ON products
+    WHEN OLD.imagem IS NOT NEW.imagem
+    BEGIN
+        DELETE FROM product_images WHERE product_id = NEW.id;
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS product_image_deleted AFTER DELETE ON products
+    BEGIN
+        DELETE FROM product_images WHERE product_id = OLD.id;
+    END
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS user_sessions (
+        user_id INTEGER PRIMARY KEY,
+        data BLOB NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        idempotency_key TEXT NOT NULL UNIQUE,
+        user_id INTEGER NOT NULL,
+        total_cents INTEGER NOT NULL,
+        created_at REAL NOT NULL
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS order_items (
+        order_id INTEGER NOT NULL REFERENCES orders(id),
+        product_id INTEGER NOT NULL,
+        nome TEXT NOT NULL,
+        quantity INTEGER NOT NULL,
+        unit_price_cents INTEGER NOT NULL,
+        subtotal_cents INTEGER NOT NULL,
+        PRIMARY KEY (order_id, product_id)
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders (user_id)")
+    _create_search_index(conn)
+    _create_catalog_version(conn)
+    _create_sales_rollups(conn)
+
+def initialize_database():
+    """Garante que o esquema do banco de dados está criado e atualizado."""
+    with get_db_pool().connection() as conn:
+        _ensure_schema(conn)
 
-def populate_initial_data():
+def _create_search_index(conn: sqlite3.Connection) -> None:
+    """Cria o índice FTS5 de `nome`/`descricao` e os triggers que o mantêm sincronizado.
+
+    O tokenizer `unicode61 remove_diacritics 2` ignora acentos e maiúsculas
+    ("bone" encontra "Boné"), e os índices de prefixo aceleram buscas parciais.
+    """
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'products_fts'").fetchone()
+    conn.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        nome, descricao,
+        content='products', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts (rowid, nome, descricao) VALUES (NEW.id, NEW.nome, NEW.descricao);
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts (products_fts, rowid, nome, descricao) VALUES ('delete', OLD.id, OLD.nome, OLD.descricao);
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF nome, descricao ON products BEGIN
+        INSERT INTO products_fts (products_fts, rowid, nome, descricao) VALUES ('delete', OLD.id, OLD.nome, OLD.descricao);
+        INSERT INTO products_fts (rowid, nome, descricao) VALUES (NEW.id, NEW.nome, NEW.descricao);
+    END
+    """)
+    if not exists:
+        conn.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+        logger.info("Índice de busca de produtos criado.")
+
+def _create_catalog_version(conn: sqlite3.Connection) -> None:
+    """Cria o contador `catalog_version`, incrementado por triggers a cada escrita em `products`.
+
+    Como os triggers rodam dentro do SQLite, qualquer escrita conta, venha ela de
+    outro worker, do `--import-catalog` ou de uma edição manual no banco. Baixas de
+    estoque não contam: o estoque é conferido no próprio UPDATE do checkout.
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS catalog_version (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL
+    )
+    """)
+    conn.execute("INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)")
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS catalog_version_insert AFTER INSERT ON products BEGIN
+        UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS catalog_version_delete AFTER DELETE ON products BEGIN
+        UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS catalog_version_update AFTER UPDATE OF sku, nome, preco_centavos, descricao, imagem ON products BEGIN
+        UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+    END
+    """)
+
+def _create_sales_rollups(conn: sqlite3.Connection) -> None:
+    """Cria o registro de doações e os totais diários usados pelo /relatorio.
+
+    `orders`/`order_items` e `donations` só recebem INSERTs (são o histórico de
+    eventos); os totais por dia são mantidos com UPSERT na mesma transação de cada
+    evento, então um relatório lê no máximo uma linha por dia e produto/valor.
+    """
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'daily_product_sales'").fetchone()
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS donations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        amount_cents INTEGER NOT NULL,
+        created_at REAL NOT NULL
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS daily_sales (
+        day TEXT PRIMARY KEY,
+        orders INTEGER NOT NULL,
+        revenue_cents INTEGER NOT NULL
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS daily_product_sales (
+        day TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        nome TEXT NOT NULL,
+        quantity INTEGER NOT NULL,
+        revenue_cents INTEGER NOT NULL,
+        PRIMARY KEY (day, product_id)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS daily_donations (
+        day TEXT NOT NULL,
+        amount_cents INTEGER NOT NULL,
+        donations INTEGER NOT NULL,
+        PRIMARY KEY (day, amount_cents)
+    ) WITHOUT ROWID
+    """)
+    if not exists: # Pedidos gravados antes dos totais diários existirem
+        offset = int(REPORT_UTC_OFFSET_HOURS * 3600)
+        conn.execute(
+            "INSERT INTO daily_sales (day, orders, revenue_cents) "
+            "SELECT date(created_at + ?, 'unixepoch'), COUNT(*), SUM(total_cents) FROM orders GROUP BY 1",
+            (offset,),
+        )
+        conn.execute(
+            "INSERT INTO daily_product_sales (day, product_id, nome, quantity, revenue_cents) "
+            "SELECT date(o.created_at + ?, 'unixepoch'), i.product_id, MAX(i.nome), SUM(i.quantity), SUM(i.subtotal_cents) "
+            "FROM order_items i JOIN orders o ON o.id = i.order_id GROUP BY 1, 2",
+            (offset,),
+        )
+
+def _populate_initial_data(conn: sqlite3.Connection) -> None:
     """Insere dados iniciais na tabela de produtos se ela estiver vazia."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM products")
-    if cursor.fetchone()[0] == 0:
+    if conn.execute("SELECT 1 FROM products LIMIT 1").fetchone() is None:
         initial_products = [
-            ("Camiseta Tech", 59.90, "Camiseta de algodão com estampa de tecnologia.", "https://placehold.co/600x400/007bff/white?text=Camiseta"),
-            ("Caneca Dev", 35.00, "Caneca de cerâmica para seu café ou chá.", "https://placehold.co/600x400/28a745/white?text=Caneca"),
-            ("Boné Hacker", 45.00, "Boné estiloso para todas as ocasiões.", "https://placehold.co/600x400/ffc107/black?text=Boné"),
-            ("Caderno Coder", 69.90, "Caderno para suas anotações e diagramas.", "https://placehold.co/600x400/dc3545/white?text=Caderno"),
+            ("PROD-1", "Camiseta Tech", 5990, "Camiseta de algodão com estampa de tecnologia.", "https://placehold.co/600x400/007bff/white?text=Camiseta", 100),
+            ("PROD-2", "Caneca Dev", 3500, "Caneca de cerâmica para seu café ou chá.", "https://placehold.co/600x400/28a745/white?text=Caneca", 100),
+            ("PROD-3", "Boné Hacker", 4500, "Boné estiloso para todas as ocasiões.", "https://placehold.co/600x400/ffc107/black?text=Boné", 100),
+            ("PROD-4", "Caderno Coder", 6990, "Caderno para suas anotações e diagramas.", "https://placehold.co/600x400/dc3545/white?text=Caderno", 100),
         ]
-        cursor.executemany("INSERT INTO products (nome, preco, descricao, imagem) VALUES (?, ?, ?, ?)", initial_products)
+        conn.executemany("INSERT INTO products (sku, nome, preco_centavos, descricao, imagem, estoque) VALUES (?, ?, ?, ?, ?, ?)", initial_products)
         conn.commit()
         logger.info(f"{len(initial_products)} produtos iniciais adicionados.")
-    conn.close()
 
-def fetch_all_products() -> list:
+PRODUCT_COLUMNS = "id, nome, preco_centavos, descricao, imagem, estoque"
+
+def _product_from_row(row: sqlite3.Row) -> dict:
+    """Dicionário do produto, com o preço (`preco`) já como `Money`."""
+    product = dict(row)
+    product["preco"] = Money(product.pop("preco_centavos"))
+    return product
+
+class CatalogSnapshot(NamedTuple):
+    """Produtos lidos do banco junto com o `catalog_version` do momento da leitura."""
+    version: int
+    products: list
+
+
+def read_catalog_version() -> int:
+    with get_db_pool().connection() as conn:
+        return _read_catalog_version(conn)
+
+def _read_catalog_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("SELECT version FROM catalog_version WHERE id = 1").fetchone()[0]
+
+def _fetch_catalog(conn: sqlite3.Connection) -> CatalogSnapshot:
+    # A versão é lida antes dos produtos: uma escrita no meio só causa uma recarga a mais
+    version = _read_catalog_version(conn)
+    rows = conn.execute(f"SELECT {PRODUCT_COLUMNS} FROM products").fetchall()
+    return CatalogSnapshot(version, [_product_from_row(row) for row in rows])
+
+def fetch_catalog() -> CatalogSnapshot:
     """Retorna todos os produtos do banco de dados."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, nome, preco, descricao, imagem FROM products")
-    products = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return products
-
-def fetch_product_by_id(product_id: int) -> Optional[dict]:
-    """Retorna um produto específico pelo ID."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, nome, preco, descricao, imagem FROM products WHERE id = ?", (product_id,))
-    product_data = cursor.fetchone()
-    conn.close()
-    return dict(product_data) if product_data else None
+    with get_db_pool().connection() as conn:
+        return _fetch_catalog(conn)
+
+def setup_database() -> CatalogSnapshot:
+    """Prepara o banco para o bot usando uma única conexão: esquema, dados iniciais e catálogo.
+
+    Retorna o catálogo lido, para pré-carregar o cache.
+    """
+    with get_db_pool().connection() as conn:
+        _ensure_schema(conn)
+        _populate_initial_data(conn)
+        return _fetch_catalog(conn)
+
+SEARCH_MIN_PREFIX = 3 # Palavras mais curtas só casam inteiras: "ca" não varre meio catálogo a cada tecla
+SEARCH_RANK_CANDIDATES = 200 # Termos com mais resultados que isso não passam pelo bm25
+
+def _fts_query(term: str) -> str:
+    """Converte o texto digitado em uma consulta FTS5 segura.
+
+    Todas as palavras precisam aparecer; só a última (a que ainda está sendo
+    digitada) casa por prefixo, e só se tiver `SEARCH_MIN_PREFIX` letras.
+    """
+    words = re.findall(r"\w+", term)
+    parts = [f'"{word}"' for word in words[:-1]]
+    if words:
+        last = words[-1]
+        parts.append(f'"{last}"*' if len(last) >= SEARCH_MIN_PREFIX else f'"{last}"')
+    return " ".join(parts)
+
+def _fold(text: str) -> list:
+    """Palavras de `text` sem acentos e em minúsculas, como o tokenizer do índice FTS5."""
+    text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+    return re.findall(r"\w+", text.casefold())
+
+def search_product_ids(term: str, limit: int, offset: int = 0) -> list:
+    """Retorna IDs de produtos que casam com `term`, do mais ao menos relevante.
+
+    O bm25 precisa olhar todos os resultados do termo (para o IDF), o que custa
+    dezenas de ms quando o termo casa com metade do catálogo. Por isso a busca
+    primeiro lê até `SEARCH_RANK_CANDIDATES` candidatos, na ordem do índice:
+    - se vierem menos que isso, o termo é seletivo e é ordenado pelo bm25
+      (o nome pesa mais que a descrição);
+    - se não, cada bloco de candidatos é ordenado por conta própria: quem tem o
+      termo no nome vem antes, e nomes mais curtos antes dos mais longos. As
+      páginas seguintes leem os próximos blocos, então a ordem entre páginas é estável.
+    """
+    query = _fts_query(term)
+    if not query:
+        return []
+    block = SEARCH_RANK_CANDIDATES
+    with get_db_pool().connection() as conn:
+        candidates = conn.execute(
+            "SELECT rowid, nome FROM products_fts WHERE products_fts MATCH ? LIMIT ?",
+            (query, -(-(offset + limit) // block) * block),
+        ).fetchall()
+        if len(candidates) < block:
+            rows = conn.execute(
+                "SELECT rowid FROM products_fts WHERE products_fts MATCH ? "
+                "ORDER BY bm25(products_fts, 10.0, 1.0) LIMIT ? OFFSET ?",
+                (query, limit, offset),
+            ).fetchall()
+            return [row[0] for row in rows]
+
+    words = _fold(term)
+    def rank(item: tuple) -> tuple:
+        position, row = item
+        name_words = _fold(row["nome"] or "")
+        in_name = all(any(name_word.startswith(word) for name_word in name_words) for word in words)
+        return position // block, not in_name, len(name_words)
+    ranked = sorted(enumerate(candidates), key=rank)
+    return [row[0] for _, row in ranked[offset:offset + limit]]
+
+async def search_products(term: str, limit: int, offset: int = 0) -> tuple:
+    """Busca produtos pelo índice FTS5; retorna (produtos, há_mais_resultados)."""
+    product_ids = await get_db_pool().run(search_product_ids, term, limit + 1, offset)
+    await catalog_cache.ensure_fresh()
+    products = [product for product in map(catalog_cache.get, product_ids[:limit]) if product]
+    return products, len(product_ids) > limit
+
+# --- Cache do Catálogo ---
+class CatalogCache:
+    """Cópia em memória da tabela `products`, indexada por ID.
+
+    A tabela muda raramente, então ela é carregada inteira de uma vez e
+    recarregada quando o TTL expira ou quando `invalidate()` é chamado após
+    uma escrita administrativa. Cada recarga incrementa `version`, permitindo
+    que quem guardou dados derivados do catálogo detecte que eles ficaram velhos.
+
+    Escritas feitas por outros processos são percebidas por `watch()`, que
+    compara o `catalog_version` do banco com o da última carga (`source_version`).
+    """
+
+    def __init__(self, ttl: float = CATALOG_TTL_SECONDS):
+        self.ttl = ttl
+        self.version = 0
+        self.source_version: Optional[int] = None
+        self._products: dict = {}
+        self._ordered_ids: list = []
+        self._loaded_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    def is_stale(self) -> bool:
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def _apply(self, snapshot: CatalogSnapshot) -> None:
+        self.source_version = snapshot.version
+        self._products = {product["id"]: product for product in snapshot.products}
+        self._ordered_ids = sorted(self._products)
+        self._loaded_at = time.monotonic()
+        self.version += 1
+        logger.debug(f"Catálogo carregado: {len(self._products)} produtos (versão {self.version}).")
+
+    def load(self, snapshot: Optional[CatalogSnapshot] = None) -> None:
+        """Carrega o catálogo de forma síncrona (usado na inicialização).
+
+        `snapshot` permite aproveitar uma leitura já feita, como a de `setup_database()`.
+        """
+        self._apply(fetch_catalog() if snapshot is None else snapshot)
+
+    async def refresh(self) -> None:
+        """Recarrega o catálogo fora do event loop, se ainda estiver velho."""
+        async with self._lock:
+            if self.is_stale():
+                self._apply(await get_db_pool().run(fetch_catalog))
+
+    async def watch(self, interval: float = CATALOG_POLL_SECONDS) -> None:
+        """Invalida o cache quando outro processo altera o catálogo (roda até ser cancelada)."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                version = await get_db_pool().run(read_catalog_version)
+            except Exception as e:
+                logger.warning(f"Falha ao consultar a versão do catálogo: {e}")
+                continue
+            if self.source_version is not None and version != self.source_version and not self.is_stale():
+                logger.info(f"Catálogo alterado no banco (versão {version}); recarregando.")
+                self.invalidate()
+
+    async def ensure_fresh(self) -> None:
+        if self.is_stale():
+            await self.refresh()
+
+    def invalidate(self) -> None:
+        """Marca o catálogo como velho; a próxima leitura recarrega do banco."""
+        self._loaded_at = None
+
+    def get(self, product_id: int) -> Optional[dict]:
+        return self._products.get(product_id)
+
+    def all(self) -> list:
+        return [self._products[product_id] for product_id in self._ordered_ids]
+
+    def __len__(self) -> int:
+        return len(self._ordered_ids)
+
+    def adjust_stock(self, product_id: int, delta: int) -> None:
+        """Aplica na cópia em memória uma baixa de estoque já confirmada no banco.
+
+        A próxima recarga do catálogo reconcilia o valor com o banco.
+        """
+        product = self._products.get(product_id)
+        if product is not None and product.get("estoque") is not None:
+            product["estoque"] += delta
+
+    def id_at(self, position: int) -> int:
+        return self._ordered_ids[position]
+
+    def products_after(self, after_id: int, limit: int) -> list:
+        """Paginação por chave (keyset): até `limit` produtos com id > `after_id`."""
+        start = bisect.bisect_right(self._ordered_ids, after_id)
+        return [self._products[product_id] for product_id in self._ordered_ids[start:start + limit]]
+
+
+catalog_cache = CatalogCache()
+
+def invalidate_catalog() -> None:
+    """Hook a ser chamado após qualquer escrita na tabela `products`."""
+    catalog_cache.invalidate()
+
+async def get_product(product_id: int) -> Optional[dict]:
+    """Retorna um produto do cache do catálogo (recarregando se necessário)."""
+    await catalog_cache.ensure_fresh()
+    return catalog_cache.get(product_id)
+
+# --- Importação/Exportação do Catálogo ---
+CATALOG_FIELDS = ("sku", "nome", "preco", "descricao", "imagem", "estoque")
+IMPORT_CHUNK_SIZE = 5000
+
+def _catalog_format(path: str, fmt: Optional[str]) -> str:
+    fmt = (fmt or os.path.splitext(path)[1].lstrip(".")).lower()
+    if fmt not in ("csv", "jsonl"):
+        raise ValueError(f"Formato de catálogo não suportado: {fmt!r} (use csv ou jsonl)")
+    return fmt
+
+def _read_catalog_records(path: str, fmt: str) -> Iterator:
+    """Lê o arquivo registro a registro, sem carregá-lo inteiro na memória.
+
+    No JSONL cada linha sai ainda como texto: o `json.loads` fica em `_catalog_rows`,
+    para que uma linha quebrada seja só mais um registro ignorado.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if fmt == "csv":
+            import csv # Só usado na importação/exportação; fica fora da inicialização do bot
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield line
+
+def _catalog_rows(records: Iterator, skipped: list) -> Iterator[tuple]:
+    """Valida/normaliza cada registro; os inválidos são ignorados com aviso e o número deles vai para `skipped`."""
+    for number, record in enumerate(records, start=1):
+        try:
+            if isinstance(record, str):
+                record = json.loads(record)
+            if not isinstance(record, dict):
+                raise ValueError(f"esperado um objeto JSON, não {type(record).__name__}")
+            sku = str(record.get("sku") or "").strip()
+            nome = str(record.get("nome") or "").strip()
+            if not sku or not nome:
+                raise ValueError("sku e nome são obrigatórios")
+            preco = Money.parse(record["preco"])
+            estoque = record.get("estoque")
+            estoque = int(estoque) if estoque not in (None, "") else None
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Registro {number} ignorado na importação: {e}")
+            skipped.append(number)
+            continue
+        yield (sku, nome, preco, record.get("descricao") or None, record.get("imagem") or None, estoque)
+
+def _chunked(iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+def import_catalog(path: str, fmt: Optional[str] = None, chunk_size: int = IMPORT_CHUNK_SIZE) -> int:
+    """Importa um catálogo CSV/JSONL para `products`, fazendo upsert por SKU.
+
+    O arquivo é processado em fluxo (gerador -> blocos de `chunk_size` linhas ->
+    `executemany` em uma transação por bloco), então a memória usada não depende
+    do tamanho do arquivo. Ao final o cache do catálogo é invalidado.
+    """
+    fmt = _catalog_format(path, fmt)
+    started = time.perf_counter()
+    imported = 0
+    skipped = []
+    with get_db_pool().connection() as conn:
+        for chunk in _chunked(_catalog_rows(_read_catalog_records(path, fmt), skipped), chunk_size):
+            with conn:
+                conn.executemany(
+                    "INSERT INTO products (sku, nome, preco_centavos, descricao, imagem, estoque) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(sku) DO UPDATE SET nome = excluded.nome, preco_centavos = excluded.preco_centavos, "
+                    "descricao = excluded.descricao, imagem = excluded.imagem, estoque = excluded.estoque",
+                    chunk,
+                )
+            imported += len(chunk)
+    invalidate_catalog()
+    elapsed = time.perf_counter() - started
+    logger.info(
+        f"{imported} produtos importados de {path} em {elapsed:.2f}s ({imported / max(elapsed, 1e-9):.0f} linhas/s); "
+        f"{len(skipped)} registros inválidos ignorados."
+    )
+    return imported
+
+def export_catalog(path: str, fmt: Optional[str] = None) -> int:
+    """Exporta `products` para CSV/JSONL, no mesmo formato aceito por `import_catalog`."""
+    fmt = _catalog_format(path, fmt)
+    started = time.perf_counter()
+    exported = 0
+    with get_db_pool().connection() as conn, open(path, "w", newline="", encoding="utf-8") as f:
+        # No arquivo o preço continua em reais ("59.90"), como na importação
+        cursor = conn.execute("SELECT sku, nome, preco_centavos, descricao, imagem, estoque FROM products ORDER BY id")
+        if fmt == "csv":
+            import csv
+            writer = csv.writer(f)
+            writer.writerow(CATALOG_FIELDS)
+        while rows := cursor.fetchmany(IMPORT_CHUNK_SIZE):
+            records = [(sku, nome, Money(cents).to_decimal(), *rest) for sku, nome, cents, *rest in rows]
+            if fmt == "csv":
+                writer.writerows(records)
+            else:
+                f.writelines(
+                    json.dumps(dict(zip(CATALOG_FIELDS, record)), ensure_ascii=False, default=float) + "\n"
+                    for record in records
+                )
+            exported += len(rows)
+    elapsed = time.perf_counter() - started
+    logger.info(f"{exported} produtos exportados para {path} em {elapsed:.2f}s ({exported / max(elapsed, 1e-9):.0f} linhas/s).")
+    return exported
+
+# --- Cache de file_id das Imagens ---
+def image_hash(image_url: str) -> str:
+    return hashlib.sha256(image_url.encode()).hexdigest()[:16]
+
+def load_image_file_ids() -> dict:
+    """Retorna {product_id: (image_hash, file_id)} de todas as imagens já enviadas."""
+    with get_db_pool().connection() as conn:
+        rows = conn.execute("SELECT product_id, image_hash, file_id FROM product_images").fetchall()
+    return {row["product_id"]: (row["image_hash"], row["file_id"]) for row in rows}
+
+def save_image_file_id(product_id: int, hash_: str, file_id: str) -> None:
+    with get_db_pool().connection() as conn:
+        with conn:
+            conn.execute(
+                "INSERT INTO product_images (product_id, image_hash, file_id, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(product_id) DO UPDATE SET image_hash = excluded.image_hash, "
+                "file_id = excluded.file_id, updated_at = excluded.updated_at",
+                (product_id, hash_, file_id, time.time()),
+            )
+
+def delete_image_file_id(product_id: int) -> None:
+    with get_db_pool().connection() as conn:
+        with conn:
+            conn.execute("DELETE FROM product_images WHERE product_id = ?", (product_id,))
+
+
+class ImageFileIdCache:
+    """Guarda o `file_id` que o Telegram devolve no primeiro envio da imagem de cada produto.
+
+    Reenviar pelo `file_id` evita que o Telegram baixe a imagem da URL externa a
+    cada visualização. A entrada só vale enquanto o hash da URL atual do produto
+    for o mesmo com que ela foi gravada.
+    """
+
+    def __init__(self):
+        self._entries: Optional[dict] = None
+
+    async def _ensure_loaded(self) -> None:
+        if self._entries is None:
+            self._entries = await get_db_pool().run(load_image_file_ids)
+
+    async def get(self, product: dict) -> Optional[str]:
+        if not product.get("imagem"):
+            return None
+        await self._ensure_loaded()
+        entry = self._entries.get(product["id"])
+        if entry is None:
+            return None
+        if entry[0] != image_hash(product["imagem"]):
+            await self.discard(product["id"])
+            return None
+        return entry[1]
+
+    async def store(self, product: dict, file_id: str) -> None:
+        await self._ensure_loaded()
+        hash_ = image_hash(product["imagem"])
+        self._entries[product["id"]] = (hash_, file_id)
+        await get_db_pool().run(save_image_file_id, product["id"], hash_, file_id)
+
+    async def discard(self, product_id: int) -> None:
+        await self._ensure_loaded()
+        if self._entries.pop(product_id, None) is not None:
+            await get_db_pool().run(delete_image_file_id, product_id)
+
+
+image_file_ids = ImageFileIdCache()
+
+async def warmup_product_images(chat_id: int) -> None:
+    """Envia todas as imagens do catálogo para um chat privado e guarda os file_id.
+
+    Pensado para rodar no deploy (`python vendas.py --warmup-images <CHAT_ID>`),
+    para que nenhum cliente pague o tempo do primeiro envio de uma imagem.
+    """
+    uploaded = 0
+    async with Bot(TELEGRAM_BOT_TOKEN, **bot_api_urls()) as bot:
+        for product in catalog_cache.all():
+            if not product.get("imagem") or await image_file_ids.get(product):
+                continue
+            try:
+                message = await bot.send_photo(chat_id=chat_id, photo=product["imagem"], disable_notification=True)
+            except Exception as e:
+                logger.warning(f"Falha ao pré-carregar imagem do produto {product['id']}: {e}")
+                continue
+            await image_file_ids.store(product, message.photo[-1].file_id)
+            uploaded += 1
+            try:
+                await message.delete()
+            except Exception as e:
+                logger.debug(f"Não foi possível apagar a mensagem de aquecimento: {e}")
+    logger.info(f"{uploaded} imagens de produtos pré-carregadas no Telegram.")
+
+# --- Persistência de Sessões ---
+def load_user_session(user_id: int) -> Optional[dict]:
+    """Lê a sessão (user_data) gravada de um usuário."""
+    with get_db_pool().connection() as conn:
+        row = conn.execute("SELECT data FROM user_sessions WHERE user_id = ?", (user_id,)).fetchone()
+    return pickle.loads(row["data"]) if row else None
+
+def save_user_sessions(pending: dict) -> None:
+    """Grava (ou apaga, quando o valor é None) várias sessões em uma única transação."""
+    now = time.time()
+    upserts = [(user_id, blob, now) for user_id, blob in pending.items() if blob is not None]
+    deletes = [(user_id,) for user_id, blob in pending.items() if blob is None]
+    with get_db_pool().connection() as conn:
+        with conn:
+            conn.executemany(
+                "INSERT INTO user_sessions (user_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                upserts,
+            )
+            conn.executemany("DELETE FROM user_sessions WHERE user_id = ?", deletes)
+
+
+class SQLiteSessionPersistence(BasePersistence):
+    """Persiste o `user_data` (carrinho, flag `waiting_for_donation`) no arquivo SQLite.
+
+    - Nada é lido na inicialização: a sessão de cada usuário é carregada sob
+      demanda em `refresh_user_data`, antes do primeiro update dele neste processo.
+    - As escritas são agrupadas: a Application chama `update_user_data` apenas a
+      cada `PERSISTENCE_FLUSH_INTERVAL` segundos, uma vez por usuário alterado, e
+      todas as sessões dessa rodada são gravadas juntas em uma transação.
+    """
+
+    def __init__(self, update_interval: float = PERSISTENCE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._loaded_users: set = set()
+        self._pending: dict = {}
+        self._write_task: Optional[asyncio.Task] = None
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._loaded_users:
+            return
+        self._loaded_users.add(user_id)
+        stored = await get_db_pool().run(load_user_session, user_id)
+        if stored:
+            for key, value in stored.items():
+                user_data.setdefault(key, value)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._pending[user_id] = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._loaded_users.discard(user_id)
+        self._pending[user_id] = None
+        self._schedule_write()
+
+    def _schedule_write(self) -> None:
+        # Todas as chamadas de uma mesma rodada caem no mesmo lote
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self) -> None:
+        await asyncio.sleep(0)
+        pending, self._pending = self._pending, {}
+        if pending:
+            await get_db_pool().run(save_user_sessions, pending)
+            logger.debug(f"{len(pending)} sessões gravadas em lote.")
+
+    async def flush(self) -> None:
+        if self._write_task is not None:
+            await self._write_task
+        await self._write_pending()
+
+    # O bot não usa chat_data, bot_data, callback_data nem ConversationHandler
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+# --- Processamento Concorrente ---
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processa updates de usuários diferentes em paralelo e os de um mesmo usuário em ordem.
+
+    Dois cliques rápidos em `add_one_` do mesmo chat nunca alteram
+    `context.user_data['cart']` ao mesmo tempo. O limite de updates em execução
+    é aplicado depois que o update conquista a vez do seu usuário, para que um
+    usuário com muitos cliques na fila não ocupe as vagas dos demais.
+
+    Com concorrência > 1 a Application cria uma task para cada update assim que
+    o tira da fila, então a fila sozinha não limita nada. Por isso quem recebe
+    os updates (o webhook e os workers) pede admissão antes de enfileirar:
+    `try_admit`/`admit` só aceitam enquanto houver menos de
+    `max_concurrent_updates + max_pending` updates pendentes (na fila,
+    esperando ou em execução), e é aí que o webhook devolve 503.
+    """
+
+    def __init__(self, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES, max_pending: int = UPDATE_QUEUE_SIZE):
+        super().__init__(max_concurrent_updates + max_pending)
+        self.concurrency_limit = max_concurrent_updates
+        self.capacity = max_concurrent_updates + max_pending
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._user_locks: dict = {}
+        self._admitted: dict = {} # update_id -> instante da admissão (ainda na fila de entrada)
+        self._queued_at: dict = {} # corrotina -> instante em que o update ficou pendente
+        self._capacity_freed = asyncio.Event()
+        self.pending = 0
+        self.active = 0
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @staticmethod
+    def _ordering_key(update: object):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    def try_admit(self, update: Update) -> bool:
+        """Reserva uma vaga para o update antes de enfileirá-lo; False se o limite de pendentes foi atingido."""
+        if self.pending >= self.capacity:
+            return False
+        self.pending += 1
+        self._admitted[update.update_id] = time.monotonic()
+        return True
+
+    async def admit(self, update: Update) -> None:
+        """Como `try_admit`, mas espera uma vaga (usado pelos workers, que não podem devolver 503)."""
+        while not self.try_admit(update):
+            self._capacity_freed.clear()
+            await self._capacity_freed.wait()
+
+    def cancel_admission(self, update: Update) -> None:
+        """Devolve a vaga de um update admitido que acabou não sendo enfileirado."""
+        if self._admitted.pop(update.update_id, None) is not None:
+            self._release()
+
+    def _release(self) -> None:
+        self.pending -= 1
+        self._capacity_freed.set()
+
+    async def process_update(self, update: object, coroutine) -> None:
+        queued_at = self._admitted.pop(getattr(update, "update_id", None), None)
+        if queued_at is None: # Não passou pela admissão (ex: polling)
+            self.pending += 1
+            queued_at = time.monotonic()
+        self._queued_at[coroutine] = queued_at
+        try:
+            await super().process_update(update, coroutine)
+        finally:
+            self._queued_at.pop(coroutine, None)
+            self._release()
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._ordering_key(update)
+        lock = None
+        if key is not None:
+            lock, users = self._user_locks.get(key, (None, 0))
+            lock = lock or asyncio.Lock()
+            self._user_locks[key] = (lock, users + 1)
+
+        started = self._queued_at.pop(coroutine, None) or time.monotonic()
+        try:
+            if lock is not None:
+                await lock.acquire()
+            try:
+                async with self._running:
+                    waited = time.monotonic() - started
+                    self.active += 1
+                    self.total_wait += waited
+                    self.max_wait = max(self.max_wait, waited)
+                    try:
+                        await coroutine
+                    finally:
+                        self.active -= 1
+                        self.processed += 1
+            finally:
+                if lock is not None:
+                    lock.release()
+        finally:
+            if key is not None:
+                lock, users = self._user_locks[key]
+                if users <= 1:
+                    del self._user_locks[key]
+                else:
+                    self._user_locks[key] = (lock, users - 1)
+
+    def stats(self) -> dict:
+        """Profundidade da fila e tempos de espera, para dimensionar o limite.
+
+        `waiting` conta todo update pendente que ainda não começou a rodar: na
+        fila de entrada, no semáforo da classe base, na vez do usuário ou no
+        limite de execução. A espera é medida desde a admissão.
+        """
+        return {
+            "limit": self.concurrency_limit,
+            "capacity": self.capacity,
+            "active": self.active,
+            "waiting": self.pending - self.active,
+            "processed": self.processed,
+            "avg_wait_ms": (self.total_wait / self.processed * 1000) if self.processed else 0.0,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# --- Limite de Envio para a API ---
+class TokenBucket:
+    """Token bucket com reserva: cada chamada reserva um token e recebe quanto deve esperar."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds: float) -> None:
+        """Bloqueia o bucket por `seconds` (usado quando o Telegram responde 429)."""
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """Fila de saída centralizada para todas as chamadas à API do Telegram.
+
+    - Um token bucket global e um por chat seguram as mensagens antes que o
+      Telegram responda 429; os pedidos esperam em ordem de chegada.
+    - Se mesmo assim vier um 429, o pedido é reenviado depois do `retry_after`
+      informado, em vez de ser descartado. Um 429 numa chamada de chat pausa o
+      bucket daquele chat; um 429 numa chamada sem chat (`answerCallbackQuery`,
+      `answerInlineQuery`...) indica limite do bot inteiro e pausa o global.
+    - Chamadas sem chat não consomem tokens (o Telegram não as conta como
+      mensagens), mas também passam pelo reenvio e respeitam a pausa global.
+    - Uma edição que sai na hora é enviada normalmente. Se ela precisa esperar
+      token, fica pendente (uma por mensagem) e o handler segue sem esperá-la;
+      edições seguintes da mesma mensagem só trocam o conteúdo da pendente, que
+      sai uma vez, com a última versão, na vaga já reservada. Assim os cliques
+      rápidos de um usuário no carrinho não ficam presos na fila do chat.
+    """
+
+    _EDIT_ENDPOINTS = frozenset({"editMessageText", "editMessageCaption", "editMessageReplyMarkup", "editMessageMedia"})
+
+    def __init__(
+        self,
+        global_rate: float = OUTBOUND_GLOBAL_RATE,
+        chat_rate: float = OUTBOUND_CHAT_RATE,
+        chat_burst: int = OUTBOUND_CHAT_BURST,
+        max_retries: int = OUTBOUND_MAX_RETRIES,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.global_paused_until = 0.0 # Pausa por 429 em chamadas sem chat
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chat_buckets: dict = {}
+        self._pending_edits: dict = {} # (chat_id, message_id) -> (callback, args, kwargs) da última versão
+        self._edit_tasks: set = set()
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        # Chamado antes de o Bot fechar as conexões: as edições pendentes ainda podem sair
+        if self._edit_tasks:
+            await asyncio.wait(set(self._edit_tasks), timeout=5)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000: # Descarta buckets de chats já cheios (ociosos)
+                self._chat_buckets = {key: b for key, b in self._chat_buckets.items() if b.tokens < b.capacity}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None # Sem chat: getMe, answerCallbackQuery...
+        if chat_bucket is None or endpoint not in self._EDIT_ENDPOINTS or data.get("message_id") is None:
+            return await self._send(callback, args, kwargs, endpoint, chat_bucket)
+
+        edit_key = (chat_id, data["message_id"])
+        if edit_key in self._pending_edits:
+            # Uma edição desta mensagem já espera token: esta só troca o conteúdo dela
+            self._pending_edits[edit_key] = (callback, args, kwargs)
+            self.coalesced += 1
+            return True
+        delay = max(chat_bucket.reserve(), self.global_bucket.reserve())
+        if delay <= 0:
+            return await self._send(callback, args, kwargs, endpoint, chat_bucket, reserved=True)
+        self._pending_edits[edit_key] = (callback, args, kwargs)
+        task = asyncio.create_task(self._send_pending_edit(edit_key, endpoint, chat_bucket, delay))
+        self._edit_tasks.add(task)
+        task.add_done_callback(self._edit_tasks.discard)
+        return True # Como uma edição de mensagem inline: o handler não recebe a Message
+
+    async def _send_pending_edit(self, edit_key: tuple, endpoint: str, chat_bucket: TokenBucket, delay: float) -> None:
+        await asyncio.sleep(delay)
+        callback, args, kwargs = self._pending_edits.pop(edit_key)
+        try:
+            await self._send(callback, args, kwargs, endpoint, chat_bucket, reserved=True)
+        except Exception as e:
+            logger.warning(f"Edição adiada não enviada ({endpoint}): {e}")
+            record_swallowed_error("OutboundRateLimiter")
+
+    async def _send(self, callback, args, kwargs, endpoint: str, chat_bucket: Optional[TokenBucket], reserved: bool = False):
+        """Envia respeitando os buckets e reenviando após 429; `reserved` indica que o token já foi reservado."""
+        for attempt in range(self.max_retries + 1):
+            if reserved:
+                reserved = False
+            elif chat_bucket is None:
+                delay = self.global_paused_until - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                delay = max(chat_bucket.reserve(), self.global_bucket.reserve())
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            try:
+                result = await self._call(callback, args, kwargs, endpoint)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                logger.warning(f"Limite do Telegram atingido ({endpoint}); nova tentativa em {retry_after}s.")
+                if chat_bucket is not None:
+                    chat_bucket.pause(retry_after)
+                else:
+                    self.global_bucket.pause(retry_after)
+                    self.global_paused_until = max(self.global_paused_until, time.monotonic() + retry_after)
+                self.retried += 1
+                continue
+            self.sent += 1
+            return result
+
+    @staticmethod
+    async def _call(callback, args, kwargs, endpoint: str):
+        if not METRICS_ENABLED:
+            return await callback(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        finally:
+            TELEGRAM_API_LATENCY.observe(time.perf_counter() - started, endpoint)
+
+    def stats(self) -> dict:
+        return {"sent": self.sent, "coalesced": self.coalesced, "retried": self.retried, "chats": len(self._chat_buckets)}
+
+# --- Listagem Paginada ---
+class ProductListingCache:
+    """Páginas de `/produtos` já renderizadas (texto + teclado) para a versão atual do catálogo.
+
+    Cada página é montada uma única vez por versão do catálogo; trocar de página
+    é apenas uma consulta a um dicionário.
+    """
+
+    def __init__(self, page_size: int = PRODUCTS_PAGE_SIZE):
+        self.page_size = max(1, page_size)
+        self._version = None
+        self._pages: dict = {}
+
+    def page_count(self) -> int:
+        return max(1, -(-len(catalog_cache) // self.page_size))
+
+    def get(self, page: int) -> tuple:
+        """Retorna (texto, reply_markup) da página, clampando para o intervalo válido."""
+        if self._version != catalog_cache.version:
+            self._pages = {}
+            self._version = catalog_cache.version
+        page = min(max(page, 0), self.page_count() - 1)
+        rendered = self._pages.get(page)
+        if rendered is None:
+            rendered = self._pages[page] = self._render(page)
+        return rendered
+
+    def _render(self, page: int) -> tuple:
+        if not len(catalog_cache):
+            return "Nenhum produto disponível no momento.", None
+
+        after_id = catalog_cache.id_at(page * self.page_size - 1) if page else -1
+        products = catalog_cache.products_after(after_id, self.page_size)
+        total_pages = self.page_count()
+
+        message_text = "🛍️ **Nossos Produtos:**\n\n"
+        buttons = []
+        for product in products:
+            message_text += f"🆔 `{product['id']}`: **{escape_md(product['nome'])}** - {product['preco']}\n"
+            buttons.append(
+                InlineKeyboardButton(f"{product['nome']} ({product['preco']})", callback_data=f"view_product_{product['id']}")
+            )
+        if total_pages > 1:
+            message_text += f"\n📄 Página {page + 1} de {total_pages}"
+
+        keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)] # Botões em 2 colunas
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"show_products:{page - 1}"))
+        if page < total_pages - 1:
+            navigation.append(InlineKeyboardButton("Próxima ➡️", callback_data=f"show_products:{page + 1}"))
+        if navigation:
+            keyboard.append(navigation)
+        keyboard.append([InlineKeyboardButton("🛒 Ver Carrinho", callback_data="show_cart")])
+        return message_text, InlineKeyboardMarkup(keyboard)
+
+
+product_listing_cache = ProductListingCache()
+
+# --- Cache de Renderização ---
+def escape_md(text: Optional[str]) -> str:
+    """Escapa texto livre (nomes, descrições, buscas) para `parse_mode="Markdown"`."""
+    return escape_markdown(text or "", version=1)
+
+class RenderCache:
+    """Cache LRU de mensagens já montadas (texto + teclado), limitado por memória.
+
+    Guarda os cards de produto, que só mudam quando o catálogo muda: a chave
+    inclui `catalog_cache.version`, então depois de uma recarga as entradas
+    antigas deixam de ser usadas e saem pelo LRU. Como o texto é escapado na
+    renderização, o escape de Markdown acontece uma vez por produto e versão.
+    """
+
+    def __init__(self, max_bytes: int = RENDER_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict() # chave -> (valor, tamanho estimado)
+
+    def get(self, key, render):
+        """Retorna o valor da chave, chamando `render()` para criá-lo se necessário."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        value = render()
+        size = _rendered_size(value)
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+        return value
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "bytes": self.size, "hits": self.hits, "misses": self.misses}
+
+
+def _rendered_size(rendered: tuple) -> int:
+    """Estimativa grosseira da memória de um (texto, reply_markup)."""
+    text, reply_markup = rendered
+    size = 100 + 2 * len(text)
+    if reply_markup is not None:
+        for row in reply_markup.inline_keyboard:
+            for button in row:
+                size += 200 + 2 * (len(button.text) + len(button.callback_data or ""))
+    return size
+
+
+render_cache = RenderCache()
+
+def _render_product_card(product: dict) -> tuple:
+    message_text = (
+        f"🖼️ **{escape_md(product['nome'])}**\n\n"
+        f"{escape_md(product['descricao'])}\n\n"
+        f"💰 **Preço:** {product['preco']}\n"
+        f"🆔: `{product['id']}`"
+    )
+    keyboard = [
+        [InlineKeyboardButton(f"➕ Adicionar ao Carrinho", callback_data=f"add_one_{product['id']}")],
+        [InlineKeyboardButton("🛍️ Voltar aos Produtos", callback_data="show_products")],
+        [InlineKeyboardButton("🛒 Ver Carrinho", callback_data="show_cart")]
+    ]
+    return message_text, InlineKeyboardMarkup(keyboard)
+
+def product_card(product: dict) -> tuple:
+    """(texto, reply_markup) do card de um produto, sem a linha de estoque (que varia por usuário)."""
+    return render_cache.get(("product", product["id"], catalog_cache.version), lambda: _render_product_card(product))
+
+# Menus que não dependem do catálogo nem do usuário: montados uma única vez
+START_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🛍️ Ver Produtos", callback_data="show_products")],
+    [InlineKeyboardButton("🛒 Meu Carrinho", callback_data="show_cart")],
+    [InlineKeyboardButton("💝 Fazer Doação", callback_data="show_donation")],
+])
+DONATION_TEXT = "💝 **Obrigado por considerar uma doação!**\n\nEscolha um valor ou digite um valor personalizado:\n"
+DONATION_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("R$ 5,00", callback_data="donate_500")],
+    [InlineKeyboardButton("R$ 10,00", callback_data="donate_1000")],
+    [InlineKeyboardButton("R$ 25,00", callback_data="donate_2500")],
+    [InlineKeyboardButton("R$ 50,00", callback_data="donate_5000")],
+    [InlineKeyboardButton("💰 Outro valor", callback_data="donate_custom")],
+    [InlineKeyboardButton("🔙 Voltar", callback_data="show_products")],
+])
+DONATION_DONE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💝 Fazer outra doação", callback_data="show_donation")],
+    [InlineKeyboardButton("🛍️ Ver Produtos", callback_data="show_products")],
+])
+HELP_TEXT = (
+    "🤖 **Comandos:**\n"
+    "/start - Iniciar conversa\n"
+    "/produtos `[página]` - Listar produtos\n"
+    "/ver `<ID>` - Ver detalhes de um produto\n"
+    "/buscar `<termo>` - Buscar produtos pelo nome ou descrição\n"
+    "/adicionar `<ID>` - Adicionar produto ao carrinho\n"
+    "/remover `<ID>` - Remover produto do carrinho\n"
+    "/carrinho - Ver seu carrinho\n"
+    "/finalizar - Finalizar compra (simulação)\n"
+    "/doar - Fazer uma doação\n"
+    "/help - Mostrar esta ajuda"
+)
 
 # --- Lógica do Carrinho ---
 def get_cart(context: ContextTypes.DEFAULT_TYPE) -> dict:
@@ -81,39 +1645,311 @@ def get_cart(context: ContextTypes.DEFAULT_TYPE) -> dict:
     context.user_data.setdefault('cart', {})
     return context.user_data['cart']
 
+def get_checkout_key(context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Chave de idempotência do carrinho atual; só muda depois de um pedido gravado.
+
+    Dois toques em 'checkout_cart' para o mesmo carrinho usam a mesma chave e,
+    portanto, geram um único pedido.
+    """
+    context.user_data.setdefault('checkout_key', uuid.uuid4().hex)
+    return context.user_data['checkout_key']
+
+class CartLine(NamedTuple):
+    product_id: int
+    nome: str
+    quantity: int
+    unit_cents: int
+    subtotal_cents: int
+    nome_md: str # `nome` já escapado para as mensagens em Markdown
+
+class CartPricing(NamedTuple):
+    lines: list
+    missing: list  # [(product_id, quantity)] de produtos que não existem mais
+    total_cents: int
+
+async def price_cart(cart: dict) -> CartPricing:
+    """Precifica o carrinho inteiro em uma única passada pelo cache do catálogo.
+
+    Compartilhado por `cart_handler` e `checkout_handler` para que carrinho e
+    finalização sempre mostrem os mesmos valores.
+    """
+    await catalog_cache.ensure_fresh()
+    lines, missing, total_cents = [], [], 0
+    for product_id, quantity in cart.items():
+        product_data = catalog_cache.get(product_id)
+        if product_data is None:
+            missing.append((product_id, quantity))
+            continue
+        unit_cents = product_data["preco"]
+        subtotal_cents = unit_cents * quantity
+        total_cents += subtotal_cents
+        lines.append(CartLine(
+            product_id, product_data["nome"], quantity, unit_cents, subtotal_cents, escape_md(product_data["nome"]),
+        ))
+    return CartPricing(lines, missing, total_cents)
+
+# --- Estoque ---
+class OutOfStockError(Exception):
+    """Algum item do pedido não tem estoque suficiente."""
+
+    def __init__(self, product_names: list):
+        super().__init__(", ".join(product_names))
+        self.product_names = product_names
+
+
+class StockLedger:
+    """Estoque disponível servido da memória, com reservas curtas de carrinho.
+
+    O estoque base vem do cache do catálogo (que é reconciliado com o banco a
+    cada recarga). Se `CART_HOLD_SECONDS` > 0, cada item colocado no carrinho
+    fica reservado para o usuário por esse tempo e deixa de aparecer como
+    disponível para os demais. A garantia final contra venda acima do estoque é
+    a baixa condicional feita na transação do checkout (`write_orders`).
+    """
+
+    def __init__(self, hold_seconds: float = CART_HOLD_SECONDS):
+        self.hold_seconds = hold_seconds
+        self._holds: dict = {} # product_id -> {user_id: (quantidade, expira_em)}
+
+    def _active_holds(self, product_id: int) -> dict:
+        holds = self._holds.get(product_id)
+        if not holds:
+            return {}
+        now = time.monotonic()
+        expired = [user_id for user_id, (_, expires_at) in holds.items() if expires_at <= now]
+        for user_id in expired:
+            del holds[user_id]
+        if not holds:
+            del self._holds[product_id]
+        return holds
+
+    def available(self, product: dict, user_id: Optional[int] = None) -> Optional[int]:
+        """Unidades que `user_id` ainda pode colocar no carrinho (None = sem controle)."""
+        stock = product.get("estoque")
+        if stock is None:
+            return None
+        held = sum(quantity for holder, (quantity, _) in self._active_holds(product["id"]).items() if holder != user_id)
+        return max(0, stock - held)
+
+    def hold(self, product_id: int, user_id: int, quantity: int) -> None:
+        """Atualiza a reserva do usuário para a quantidade atual no carrinho."""
+        if self.hold_seconds <= 0:
+            return
+        if quantity <= 0:
+            self._holds.get(product_id, {}).pop(user_id, None)
+            return
+        self._holds.setdefault(product_id, {})[user_id] = (quantity, time.monotonic() + self.hold_seconds)
+
+    def release(self, user_id: int, product_ids) -> None:
+        for product_id in product_ids:
+            self._holds.get(product_id, {}).pop(user_id, None)
+
+
+stock_ledger = StockLedger()
+
+def try_add_to_cart(cart: dict, product: dict, user_id: int) -> bool:
+    """Adiciona uma unidade ao carrinho se houver estoque disponível."""
+    product_id = product["id"]
+    available = stock_ledger.available(product, user_id)
+    if available is not None and cart.get(product_id, 0) + 1 > available:
+        return False
+    cart[product_id] = cart.get(product_id, 0) + 1
+    stock_ledger.hold(product_id, user_id, cart[product_id])
+    return True
+
+# --- Pedidos ---
+class NewOrder(NamedTuple):
+    idempotency_key: str
+    user_id: int
+    pricing: CartPricing
+
+def write_orders(orders: list) -> list:
+    """Grava vários pedidos (e seus itens) em uma única transação.
+
+    Retorna, na mesma ordem, `(id_do_pedido, criado)` para cada pedido ou um
+    `OutOfStockError` para os pedidos que não puderam ser atendidos. Cada pedido roda em um SAVEPOINT: a
+    baixa de estoque é um UPDATE condicional (`estoque >= quantidade`), e se algum
+    item falhar só aquele pedido é desfeito. Um pedido cuja chave de
+    idempotência já existe não é gravado de novo; o ID do pedido original é devolvido.
+    """
+    results = []
+    now = time.time()
+    with get_db_pool().connection() as conn:
+        with conn:
+            # Abre o lote explicitamente: o sqlite3 não inicia transação antes de SELECT nem de SAVEPOINT,
+            # e sem isso cada RELEASE confirmaria um pedido por vez
+            conn.execute("BEGIN IMMEDIATE")
+            for order in orders:
+                row = conn.execute("SELECT id FROM orders WHERE idempotency_key = ?", (order.idempotency_key,)).fetchone()
+                if row:
+                    results.append((row["id"], False))
+                    continue
+
+                conn.execute("SAVEPOINT order_write")
+                out_of_stock = []
+                for line in order.pricing.lines:
+                    cursor = conn.execute(
+                        "UPDATE products SET estoque = estoque - ? WHERE id = ? AND estoque IS NOT NULL AND estoque >= ?",
+                        (line.quantity, line.product_id, line.quantity),
+                    )
+                    if cursor.rowcount == 0 and conn.execute(
+                        "SELECT 1 FROM products WHERE id = ? AND estoque IS NOT NULL", (line.product_id,)
+                    ).fetchone():
+                        out_of_stock.append(line.nome)
+                if out_of_stock:
+                    conn.execute("ROLLBACK TO order_write")
+                    conn.execute("RELEASE order_write")
+                    results.append(OutOfStockError(out_of_stock))
+                    continue
+
+                cursor = conn.execute(
+                    "INSERT INTO orders (idempotency_key, user_id, total_cents, created_at) VALUES (?, ?, ?, ?)",
+                    (order.idempotency_key, order.user_id, order.pricing.total_cents, now),
+                )
+                order_id = cursor.lastrowid
+                conn.executemany(
+                    "INSERT INTO order_items (order_id, product_id, nome, quantity, unit_price_cents, subtotal_cents) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(order_id, line.product_id, line.nome, line.quantity, line.unit_cents, line.subtotal_cents)
+                     for line in order.pricing.lines],
+                )
+                _add_order_to_rollups(conn, report_day(now), order)
+                conn.execute("RELEASE order_write")
+                results.append((order_id, True))
+    return results
+
+
+class OrderWriter:
+    """Agrupa os checkouts que chegam ao mesmo tempo e os grava em lote (group commit).
+
+    Enquanto um lote está sendo gravado no pool de conexões, os novos checkouts
+    se acumulam e seguem juntos na próxima transação. Cada chamador recebe o ID
+    do seu pedido quando o lote dele é confirmado.
+    """
+
+    def __init__(self, max_batch: int = 200):
+        self.max_batch = max_batch
+        self._pending: list = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def submit(self, order: NewOrder) -> int:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((order, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._drain())
+        return await future
+
+    async def _drain(self) -> None:
+        await asyncio.sleep(0) # Junta os checkouts do mesmo ciclo do event loop
+        while self._pending:
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            try:
+                results = await get_db_pool().run(write_orders, [order for order, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (order, future), result in zip(batch, results):
+                if isinstance(result, OutOfStockError):
+                    catalog_cache.invalidate() # A memória estava otimista; reconcilia com o banco
+                    if not future.done():
+                        future.set_exception(result)
+                    continue
+                order_id, created = result
+                if created:
+                    for line in order.pricing.lines:
+                        catalog_cache.adjust_stock(line.product_id, -line.quantity)
+                if not future.done():
+                    future.set_result(order_id)
+
+
+order_writer = OrderWriter()
+
+# --- Relatórios ---
+def report_day(timestamp: float) -> str:
+    """Dia (AAAA-MM-DD) de um instante, no fuso dos relatórios."""
+    return time.strftime("%Y-%m-%d", time.gmtime(timestamp + REPORT_UTC_OFFSET_HOURS * 3600))
+
+def _add_order_to_rollups(conn: sqlite3.Connection, day: str, order: NewOrder) -> None:
+    conn.execute(
+        "INSERT INTO daily_sales (day, orders, revenue_cents) VALUES (?, 1, ?) "
+        "ON CONFLICT(day) DO UPDATE SET orders = orders + 1, revenue_cents = revenue_cents + excluded.revenue_cents",
+        (day, order.pricing.total_cents),
+    )
+    conn.executemany(
+        "INSERT INTO daily_product_sales (day, product_id, nome, quantity, revenue_cents) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(day, product_id) DO UPDATE SET nome = excluded.nome, "
+        "quantity = quantity + excluded.quantity, revenue_cents = revenue_cents + excluded.revenue_cents",
+        [(day, line.product_id, line.nome, line.quantity, line.subtotal_cents) for line in order.pricing.lines],
+    )
+
+def record_donation(user_id: int, amount_cents: int) -> None:
+    """Registra uma doação e atualiza o total diário por valor, na mesma transação."""
+    now = time.time()
+    with get_db_pool().connection() as conn:
+        with conn:
+            conn.execute(
+                "INSERT INTO donations (user_id, amount_cents, created_at) VALUES (?, ?, ?)",
+                (user_id, amount_cents, now),
+            )
+            conn.execute(
+                "INSERT INTO daily_donations (day, amount_cents, donations) VALUES (?, ?, 1) "
+                "ON CONFLICT(day, amount_cents) DO UPDATE SET donations = donations + 1",
+                (report_day(now), amount_cents),
+            )
+
+def fetch_sales_report(first_day: str, top_products: int = 10) -> dict:
+    """Totais de vendas e doações a partir de `first_day`, lidos só das tabelas diárias."""
+    with get_db_pool().connection() as conn:
+        orders, revenue_cents = conn.execute(
+            "SELECT COALESCE(SUM(orders), 0), COALESCE(SUM(revenue_cents), 0) FROM daily_sales WHERE day >= ?",
+            (first_day,),
+        ).fetchone()
+        products = conn.execute(
+            "SELECT product_id, MAX(nome) AS nome, SUM(quantity) AS quantity, SUM(revenue_cents) AS revenue_cents "
+            "FROM daily_product_sales WHERE day >= ? GROUP BY product_id ORDER BY revenue_cents DESC LIMIT ?",
+            (first_day, top_products),
+        ).fetchall()
+        donations = conn.execute(
+            "SELECT amount_cents, SUM(donations) AS donations FROM daily_donations WHERE day >= ? "
+            "GROUP BY amount_cents ORDER BY amount_cents",
+            (first_day,),
+        ).fetchall()
+    return {
+        "orders": orders,
+        "revenue_cents": revenue_cents,
+        "products": [dict(row) for row in products],
+        "donations": [dict(row) for row in donations],
+    }
+
 # --- Comandos do Bot ---
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handler para o comando /start."""
+    """Handler para o comando /start (e para os links `?start=ver_ID` compartilhados pelo modo inline)."""
+    if context.args and context.args[0].startswith("ver_"):
+        try:
+            product_id = int(context.args[0].removeprefix("ver_"))
+        except ValueError:
+            pass
+        else:
+            await view_product_handler(update, context, product_id)
+            return
     user = update.effective_user
-    keyboard = [
-        [InlineKeyboardButton("🛍️ Ver Produtos", callback_data="show_products")],
-        [InlineKeyboardButton("🛒 Meu Carrinho", callback_data="show_cart")],
-        [InlineKeyboardButton("💝 Fazer Doação", callback_data="show_donation")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_html(
         rf"Olá {user.mention_html()}! Bem-vindo(a) à Loja Virtual. Use os botões ou comandos.",
-        reply_markup=reply_markup,
+        reply_markup=START_MARKUP,
     )
 
-async def products_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handler para o comando /produtos e callback 'show_products'."""
-    products = fetch_all_products()
-    if not products:
-        message_text = "Nenhum produto disponível no momento."
-        reply_markup = None
-    else:
-        message_text = "🛍️ **Nossos Produtos:**\n\n"
-        buttons = []
-        for product in products:
-            message_text += f"🆔 `{product['id']}`: **{product['nome']}** - R$ {product['preco']:.2f}\n"
-            buttons.append(
-                InlineKeyboardButton(f"{product['nome']} (R$ {product['preco']:.2f})", callback_data=f"view_product_{product['id']}")
-            )
-        
-        keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)] # Botões em 2 colunas
-        keyboard.append([InlineKeyboardButton("🛒 Ver Carrinho", callback_data="show_cart")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+async def products_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, page: Optional[int] = None) -> None:
+    """Handler para o comando /produtos [página] e callbacks 'show_products[:página]'."""
+    if page is None:
+        try:
+            page = int(context.args[0]) - 1 if context.args else 0
+        except ValueError:
+            page = 0
+
+    await catalog_cache.ensure_fresh()
+    message_text, reply_markup = product_listing_cache.get(page)
 
     if update.callback_query:
         try:
@@ -121,10 +1957,8 @@ async def products_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             await update.callback_query.answer()
         except Exception as e:
             logger.warning(f"Erro ao editar mensagem de produtos: {e}")
-            try:
-                await update.callback_query.answer()
-            except:
-                pass
+            record_swallowed_error("products_handler")
+            await answer_callback(update.callback_query)
     else:
         await update.message.reply_text(message_text, parse_mode="Markdown", reply_markup=reply_markup)
 
@@ -136,13 +1970,15 @@ async def add_to_cart_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("Uso: `/adicionar <ID_DO_PRODUTO>` (ex: `/adicionar 1`)")
         return
 
-    product_data = fetch_product_by_id(product_id)
+    product_data = await get_product(product_id)
     if not product_data:
         await update.message.reply_text(f"Produto com ID {product_id} não encontrado.")
         return
 
     cart = get_cart(context)
-    cart[product_id] = cart.get(product_id, 0) + 1
+    if not try_add_to_cart(cart, product_data, update.effective_user.id):
+        await update.message.reply_text(f"❌ '{product_data['nome']}' sem estoque disponível.")
+        return
     
     await update.message.reply_text(f"✅ '{product_data['nome']}' adicionado ao carrinho.")
 
@@ -155,7 +1991,7 @@ async def remove_from_cart_handler(update: Update, context: ContextTypes.DEFAULT
         return
 
     cart = get_cart(context)
-    product_data = fetch_product_by_id(product_id)
+    product_data = await get_product(product_id)
 
     if not product_data:
         await update.message.reply_text(f"Produto com ID {product_id} não existe na loja.")
@@ -166,6 +2002,7 @@ async def remove_from_cart_handler(update: Update, context: ContextTypes.DEFAULT
         return
 
     cart[product_id] -= 1
+    stock_ledger.hold(product_id, update.effective_user.id, cart[product_id])
     if cart[product_id] == 0:
         del cart[product_id]
         await update.message.reply_text(f"🗑️ '{product_data['nome']}' removido completamente do carrinho.")
@@ -179,20 +2016,16 @@ async def cart_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         message_text = "Seu carrinho está vazio. 🛒"
         keyboard = [[InlineKeyboardButton("🛍️ Ver Produtos", callback_data="show_products")]]
     else:
+        pricing = await price_cart(cart)
         message_text = "🛒 **Seu Carrinho:**\n\n"
-        total_price = 0
         item_buttons = []
-        for product_id, quantity in cart.items():
-            product_data = fetch_product_by_id(product_id)
-            if product_data:
-                subtotal = product_data["preco"] * quantity
-                total_price += subtotal
-                message_text += f"🔹 {product_data['nome']} (x{quantity}) - R$ {subtotal:.2f}\n"
-                item_buttons.append(InlineKeyboardButton(f"➖ Remover 1 {product_data['nome']}", callback_data=f"remove_one_{product_id}"))
-            else: # Caso o produto tenha sido removido do DB mas ainda esteja no carrinho de alguém
-                message_text += f"🔹 Produto ID {product_id} (indisponível) (x{quantity})\n"
+        for line in pricing.lines:
+            message_text += f"🔹 {line.nome_md} (x{line.quantity}) - {Money(line.subtotal_cents)}\n"
+            item_buttons.append(InlineKeyboardButton(f"➖ Remover 1 {line.nome}", callback_data=f"remove_one_{line.product_id}"))
+        for product_id, quantity in pricing.missing: # Caso o produto tenha sido removido do DB mas ainda esteja no carrinho de alguém
+            message_text += f"🔹 Produto ID {product_id} (indisponível) (x{quantity})\n"
         
-        message_text += f"\n💰 **Total: R$ {total_price:.2f}**"
+        message_text += f"\n💰 **Total: {Money(pricing.total_cents)}**"
         
         keyboard = [[btn] for btn in item_buttons] # Cada botão de remoção em uma linha
         keyboard.append([InlineKeyboardButton("🛍️ Continuar Comprando", callback_data="show_products")])
@@ -207,10 +2040,8 @@ async def cart_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             await update.callback_query.answer()
         except Exception as e:
             logger.warning(f"Erro ao editar mensagem do carrinho: {e}")
-            try:
-                await update.callback_query.answer()
-            except:
-                pass
+            record_swallowed_error("cart_handler")
+            await answer_callback(update.callback_query)
     else:
         await update.message.reply_text(message_text, parse_mode="Markdown", reply_markup=reply_markup)
 
@@ -221,15 +2052,31 @@ async def checkout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         message_text = "Seu carrinho está vazio para finalizar."
         keyboard = [[InlineKeyboardButton("🛍️ Ver Produtos", callback_data="show_products")]]
     else:
-        total_price = 0
-        order_summary = "📄 **Resumo do Pedido:**\n"
-        for product_id, quantity in cart.items():
-            product_data = fetch_product_by_id(product_id)
-            if product_data:
-                subtotal = product_data["preco"] * quantity
-                total_price += subtotal
-                order_summary += f"  - {product_data['nome']} (x{quantity}) - R$ {subtotal:.2f}\n"
-        order_summary += f"\n💸 **Total a Pagar: R$ {total_price:.2f}**\n\n"
+        pricing = await price_cart(cart)
+        if pricing.lines:
+            try:
+                order_id = await order_writer.submit(NewOrder(get_checkout_key(context), update.effective_user.id, pricing))
+            except OutOfStockError as e:
+                error_text = f"❌ Estoque insuficiente para: {', '.join(e.product_names)}. Ajuste seu carrinho e tente novamente."
+                if update.callback_query:
+                    await answer_callback(update.callback_query, error_text, show_alert=True)
+                else:
+                    await update.message.reply_text(error_text)
+                return
+            except Exception as e:
+                logger.error(f"Erro ao gravar pedido: {e}")
+                error_text = "❌ Não foi possível registrar seu pedido agora. Seu carrinho foi mantido; tente novamente."
+                if update.callback_query:
+                    await answer_callback(update.callback_query, error_text, show_alert=True)
+                else:
+                    await update.message.reply_text(error_text)
+                return
+            order_summary = f"📄 **Resumo do Pedido nº {order_id}:**\n"
+        else:
+            order_summary = "📄 **Resumo do Pedido:**\n"
+        for line in pricing.lines:
+            order_summary += f"  - {line.nome_md} (x{line.quantity}) - {Money(line.subtotal_cents)}\n"
+        order_summary += f"\n💸 **Total a Pagar: {Money(pricing.total_cents)}**\n\n"
 
         message_text = (
             f"{order_summary}"
@@ -237,7 +2084,9 @@ async def checkout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             "(Simulação de pedido concluído. Nenhum pagamento real processado.)\n"
             "Seu carrinho foi esvaziado."
         )
+        stock_ledger.release(update.effective_user.id, list(cart))
         context.user_data['cart'] = {} # Limpa o carrinho
+        context.user_data.pop('checkout_key', None) # O próximo carrinho é um novo pedido
         keyboard = [[InlineKeyboardButton("🛍️ Comprar Novamente", callback_data="show_products")]]
     
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -247,25 +2096,15 @@ async def checkout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             await update.callback_query.answer(text="Pedido finalizado!")
         except Exception as e:
             logger.warning(f"Erro ao finalizar compra: {e}")
-            try:
-                await update.callback_query.answer(text="Pedido finalizado!")
-            except:
-                pass
+            record_swallowed_error("checkout_handler")
+            await answer_callback(update.callback_query, "Pedido finalizado!")
     else:
         await update.message.reply_text(message_text, parse_mode="Markdown", reply_markup=reply_markup)
 
-async def view_product_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def view_product_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id: Optional[int] = None) -> None:
     """Handler para o comando /ver e callback 'view_product_ID'."""
-    product_id = -1
-    if update.callback_query: # Veio de um botão
-        try:
-            product_id = int(update.callback_query.data.split("_")[-1])
-        except (IndexError, ValueError):
-            try:
-                await update.callback_query.answer("ID de produto inválido no callback.", show_alert=True)
-            except:
-                pass
-            return
+    if product_id is not None: # Veio de um botão (ID já extraído pelo roteador)
+        pass
     elif context.args: # Veio de um comando /ver ID
         try:
             product_id = int(context.args[0])
@@ -276,29 +2115,18 @@ async def view_product_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("Uso: `/ver <ID_DO_PRODUTO>` (ex: `/ver 1`)")
         return
 
-    product_data = fetch_product_by_id(product_id)
+    product_data = await get_product(product_id)
     if not product_data:
         if update.callback_query:
-            try:
-                await update.callback_query.answer("Produto não encontrado.", show_alert=True)
-            except:
-                pass
+            await answer_callback(update.callback_query, "Produto não encontrado.", show_alert=True)
         else:
             await update.message.reply_text(f"Produto com ID {product_id} não encontrado.")
         return
 
-    message_text = (
-        f"🖼️ **{product_data['nome']}**\n\n"
-        f"{product_data['descricao']}\n\n"
-        f"💰 **Preço:** R$ {product_data['preco']:.2f}\n"
-        f"🆔: `{product_data['id']}`"
-    )
-    keyboard = [
-        [InlineKeyboardButton(f"➕ Adicionar ao Carrinho", callback_data=f"add_one_{product_id}")],
-        [InlineKeyboardButton("🛍️ Voltar aos Produtos", callback_data="show_products")],
-        [InlineKeyboardButton("🛒 Ver Carrinho", callback_data="show_cart")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    message_text, reply_markup = product_card(product_data)
+    available = stock_ledger.available(product_data, update.effective_user.id)
+    if available is not None:
+        message_text += f"\n📦 **Estoque:** {available if available else 'esgotado'}"
 
     target_message = update.callback_query.message if update.callback_query else update.message
 
@@ -307,13 +2135,22 @@ async def view_product_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             if update.callback_query and target_message.photo: # Edita se já tem foto
                  await target_message.edit_caption(caption=message_text, parse_mode="Markdown", reply_markup=reply_markup)
             else: # Envia nova foto (ou substitui texto por foto)
+                cached_file_id = await image_file_ids.get(product_data)
                 if update.callback_query: await target_message.delete() # Remove msg anterior se era callback
-                await target_message.reply_photo(
-                    photo=product_data["imagem"],
-                    caption=message_text,
-                    parse_mode="Markdown",
-                    reply_markup=reply_markup
-                )
+                try:
+                    sent = await target_message.reply_photo(
+                        photo=cached_file_id or product_data["imagem"],
+                        caption=message_text,
+                        parse_mode="Markdown",
+                        reply_markup=reply_markup
+                    )
+                except BadRequest as e:
+                    # Só um file_id recusado pelo Telegram invalida o cache (não erros de Markdown ou de rede)
+                    if cached_file_id and "file" in e.message.lower():
+                        await image_file_ids.discard(product_id)
+                    raise
+                if not cached_file_id and sent.photo:
+                    await image_file_ids.store(product_data, sent.photo[-1].file_id)
         else: # Sem imagem, apenas texto
             if update.callback_query:
                 await target_message.edit_text(text=message_text, parse_mode="Markdown", reply_markup=reply_markup)
@@ -321,62 +2158,47 @@ async def view_product_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                 await target_message.reply_text(text=message_text, parse_mode="Markdown", reply_markup=reply_markup)
     except Exception as e:
         logger.warning(f"Erro ao exibir produto {product_id}: {e}")
+        record_swallowed_error("view_product_handler")
         # Fallback para mensagem de texto simples em caso de erro
         try:
             await target_message.reply_text(text=message_text, parse_mode="Markdown", reply_markup=reply_markup)
-        except:
-            pass
+        except Exception as e:
+            logger.debug(f"Fallback de texto do produto {product_id} também falhou: {e}")
     
     if update.callback_query:
-        try:
-            await update.callback_query.answer()
-        except:
-            pass
+        await answer_callback(update.callback_query)
 
 
 async def donation_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handler para o comando /doar e callback 'show_donation'."""
-    message_text = "💝 **Obrigado por considerar uma doação!**\n\nEscolha um valor ou digite um valor personalizado:\n"
-    
-    keyboard = [
-        [InlineKeyboardButton("R$ 5,00", callback_data="donate_500")],
-        [InlineKeyboardButton("R$ 10,00", callback_data="donate_1000")],
-        [InlineKeyboardButton("R$ 25,00", callback_data="donate_2500")],
-        [InlineKeyboardButton("R$ 50,00", callback_data="donate_5000")],
-        [InlineKeyboardButton("💰 Outro valor", callback_data="donate_custom")],
-        [InlineKeyboardButton("🔙 Voltar", callback_data="show_products")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
+    message_text, reply_markup = DONATION_TEXT, DONATION_MARKUP
+
     if update.callback_query:
         try:
             await update.callback_query.message.edit_text(message_text, parse_mode="Markdown", reply_markup=reply_markup)
             await update.callback_query.answer()
         except Exception as e:
             logger.warning(f"Erro ao editar mensagem de doação: {e}")
-            try:
-                await update.callback_query.answer()
-            except:
-                pass
+            record_swallowed_error("donation_handler")
+            await answer_callback(update.callback_query)
     else:
         await update.message.reply_text(message_text, parse_mode="Markdown", reply_markup=reply_markup)
 
 
 async def process_donation(update: Update, context: ContextTypes.DEFAULT_TYPE, amount_cents: int) -> None:
     """Processa a doação e exibe resumo."""
-    amount_reais = amount_cents / 100
+    try:
+        await get_db_pool().run(record_donation, update.effective_user.id, amount_cents)
+    except Exception as e: # O registro é só para os relatórios; não impede o agradecimento
+        logger.warning(f"Erro ao registrar doação: {e}")
+        record_swallowed_error("record_donation")
     message_text = (
         f"💖 **Obrigado pela generosa doação!**\n\n"
-        f"Valor doado: **R$ {amount_reais:.2f}**\n\n"
+        f"Valor doado: **{Money(amount_cents)}**\n\n"
         f"(Simulação de pagamento concluído. Nenhum pagamento real processado.)\n\n"
         f"Sua doação ajuda muito! 🙏"
     )
-    
-    keyboard = [
-        [InlineKeyboardButton("💝 Fazer outra doação", callback_data="show_donation")],
-        [InlineKeyboardButton("🛍️ Ver Produtos", callback_data="show_products")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = DONATION_DONE_MARKUP
     
     if update.callback_query:
         try:
@@ -384,10 +2206,8 @@ async def process_donation(update: Update, context: ContextTypes.DEFAULT_TYPE, a
             await update.callback_query.answer(text="Doação processada! Obrigado! 💖")
         except Exception as e:
             logger.warning(f"Erro ao processar doação: {e}")
-            try:
-                await update.callback_query.answer(text="Doação processada! Obrigado! 💖")
-            except:
-                pass
+            record_swallowed_error("process_donation")
+            await answer_callback(update.callback_query, "Doação processada! Obrigado! 💖")
     else:
         await update.message.reply_text(message_text, parse_mode="Markdown", reply_markup=reply_markup)
 
@@ -396,181 +2216,967 @@ async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     """Handler para mensagens de texto (doação personalizada)."""
     if context.user_data.get('waiting_for_donation'):
         try:
-            # Tenta converter para float
-            amount_str = update.message.text.replace(',', '.').strip()
-            amount_reais = float(amount_str)
-            
-            if amount_reais <= 0:
+            amount_cents = Money.parse(update.message.text)
+            if amount_cents <= 0:
                 await update.message.reply_text("❌ Por favor, digite um valor maior que 0. (ex: 25 para R$ 25,00)")
                 return
-            
-            amount_cents = int(amount_reais * 100)
+
             context.user_data['waiting_for_donation'] = False
             await process_donation(update, context, amount_cents)
         except ValueError:
-            await update.message.reply_text("❌ Valor inválido! Digite apenas números. (ex: 25 para R$ 25,00)")
+            await update.message.reply_text(
+                f"❌ Valor inválido! Digite apenas números, até {Money(Money.MAX_CENTS)}. (ex: 25 para R$ 25,00)"
+            )
+
+
+# --- Busca ---
+SEARCH_HISTORY_SIZE = 10 # Mensagens de resultado por usuário cujos botões de página continuam funcionando
+
+def remember_search(context: ContextTypes.DEFAULT_TYPE, message_id: int, term: str) -> None:
+    """Associa o termo à mensagem de resultados, para que cada mensagem pagine a sua própria busca."""
+    searches = context.user_data.setdefault('searches', {})
+    searches[message_id] = term
+    while len(searches) > SEARCH_HISTORY_SIZE:
+        del searches[next(iter(searches))]
+
+async def search_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, page: Optional[int] = None) -> None:
+    """Handler para o comando /buscar <termo> e callbacks 'search:<página>'."""
+    if page is None:
+        term = " ".join(context.args).strip()
+        if not term:
+            await update.message.reply_text("Uso: `/buscar <termo>` (ex: `/buscar camiseta`)", parse_mode="Markdown")
+            return
+        page = 0
+    else:
+        term = context.user_data.get('searches', {}).get(update.callback_query.message.message_id)
+        if term is None:
+            await answer_callback(update.callback_query, "Esta busca expirou. Use /buscar novamente.", show_alert=True)
+            return
+
+    page = max(page, 0)
+    products, has_more = await search_products(term, PRODUCTS_PAGE_SIZE, page * PRODUCTS_PAGE_SIZE)
+    if not products:
+        message_text = f"🔍 Nenhum produto encontrado para \"{escape_md(term)}\"."
+        if len((re.findall(r"\w+", term) or [""])[-1]) < SEARCH_MIN_PREFIX:
+            message_text += f"\nPalavras com menos de {SEARCH_MIN_PREFIX} letras só encontram nomes com a palavra inteira."
+        keyboard = [[InlineKeyboardButton("🛍️ Ver Produtos", callback_data="show_products")]]
+    else:
+        message_text = f"🔍 **Resultados para \"{escape_md(term)}\":**\n\n"
+        buttons = []
+        for product in products:
+            message_text += f"🆔 `{product['id']}`: **{escape_md(product['nome'])}** - {product['preco']}\n"
+            buttons.append(InlineKeyboardButton(f"{product['nome']} ({product['preco']})", callback_data=f"view_product_{product['id']}"))
+        keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"search:{page - 1}"))
+        if has_more:
+            navigation.append(InlineKeyboardButton("Próxima ➡️", callback_data=f"search:{page + 1}"))
+        if navigation:
+            keyboard.append(navigation)
+        keyboard.append([InlineKeyboardButton("🛒 Ver Carrinho", callback_data="show_cart")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    if update.callback_query:
+        try:
+            await update.callback_query.message.edit_text(message_text, parse_mode="Markdown", reply_markup=reply_markup)
+        except Exception as e:
+            logger.warning(f"Erro ao editar mensagem de busca: {e}")
+            record_swallowed_error("search_handler")
+        await answer_callback(update.callback_query)
+    else:
+        sent = await update.message.reply_text(message_text, parse_mode="Markdown", reply_markup=reply_markup)
+        remember_search(context, sent.message_id, term)
 
+INLINE_QUERY_LIMIT = 20
+
+class InlineResultCache:
+    """Respostas inline já montadas, com TTL curto, por (consulta normalizada, offset, versão do catálogo).
+
+    Enquanto o usuário digita, o Telegram manda uma consulta a cada tecla, e
+    apagar/redigitar ou vários usuários buscando a mesma coisa repetem as mesmas
+    consultas: elas saem daqui sem tocar no índice de busca. A versão do catálogo
+    na chave descarta as respostas de antes de uma alteração nos produtos.
+    """
+
+    def __init__(self, ttl: float = INLINE_RESULT_CACHE_SECONDS, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict() # chave -> (expira_em, resultados, next_offset)
+
+    def get(self, key) -> Optional[tuple]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def put(self, key, results: list, next_offset: str) -> None:
+        if self.ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, results, next_offset)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+inline_result_cache = InlineResultCache()
+
+def _inline_result(product: dict, file_id: Optional[str], bot_link: str):
+    """Resultado inline de um produto: a foto já enviada ao Telegram (pelo file_id) ou um artigo."""
+    text = f"🛍️ **{escape_md(product['nome'])}** - {product['preco']}\n{escape_md(product['descricao'])}"
+    # Quem recebe a mensagem compartilhada abre o produto no bot pelo link ?start=ver_ID
+    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🛍️ Ver na Loja", url=f"{bot_link}?start=ver_{product['id']}")]])
+    description = f"{product['preco']} - {product['descricao'] or ''}"
+    if file_id:
+        return InlineQueryResultCachedPhoto(
+            id=str(product["id"]),
+            photo_file_id=file_id,
+            title=product["nome"],
+            description=description,
+            caption=text,
+            parse_mode="Markdown",
+            reply_markup=reply_markup,
+        )
+    return InlineQueryResultArticle(
+        id=str(product["id"]),
+        title=product["nome"],
+        description=description,
+        thumbnail_url=product.get("imagem"),
+        input_message_content=InputTextMessageContent(text, parse_mode="Markdown"),
+        reply_markup=reply_markup,
+    )
+
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Responde buscas inline (`@bot termo`) com os produtos encontrados; sem termo, navega pelo catálogo."""
+    inline_query = update.inline_query
+    try:
+        offset = max(int(inline_query.offset or 0), 0)
+    except ValueError:
+        offset = 0
+    await catalog_cache.ensure_fresh()
+    query = _fts_query(inline_query.query.casefold())
+    key = (query, offset, catalog_cache.version)
+
+    cached = inline_result_cache.get(key)
+    if cached is not None:
+        results, next_offset = cached
+    else:
+        if query:
+            products, has_more = await search_products(inline_query.query, INLINE_QUERY_LIMIT, offset)
+        else:
+            page = catalog_cache.all()[offset:offset + INLINE_QUERY_LIMIT + 1]
+            products, has_more = page[:INLINE_QUERY_LIMIT], len(page) > INLINE_QUERY_LIMIT
+        results = [_inline_result(product, await image_file_ids.get(product), context.bot.link) for product in products]
+        next_offset = str(offset + INLINE_QUERY_LIMIT) if has_more else ""
+        inline_result_cache.put(key, results, next_offset)
+
+    # A resposta não depende de quem pergunta: o Telegram pode reaproveitá-la para todos por cache_time
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=False, next_offset=next_offset)
 
 # --- Callbacks para Botões Inline ---
+async def answer_callback(query, text: Optional[str] = None, show_alert: bool = False) -> None:
+    """Responde um callback query ignorando falhas (ex: query já expirada)."""
+    try:
+        await query.answer(text=text, show_alert=show_alert)
+    except Exception as e:
+        logger.debug(f"Falha ao responder callback: {e}")
+        record_swallowed_error("answer_callback")
+
+async def add_one_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id: int) -> None:
+    """Callback 'add_one_ID': adiciona uma unidade ao carrinho."""
+    query = update.callback_query
+    product_data = await get_product(product_id)
+    if not product_data:
+        await answer_callback(query, "Produto não mais disponível.", show_alert=True)
+        return
+
+    cart = get_cart(context)
+    if not try_add_to_cart(cart, product_data, update.effective_user.id):
+        await answer_callback(query, f"❌ '{product_data['nome']}' sem estoque disponível.", show_alert=True)
+        return
+    await answer_callback(query, f"✅ '{product_data['nome']}' adicionado!")
+
+async def remove_one_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id: int) -> None:
+    """Callback 'remove_one_ID': remove uma unidade do carrinho e atualiza a mensagem."""
+    query = update.callback_query
+    cart = get_cart(context)
+    product_data = await get_product(product_id)
+
+    if not product_data: # Produto não existe mais no DB
+        if product_id in cart: del cart[product_id]
+        await answer_callback(query, "Produto não encontrado. Removido do carrinho se estava lá.", show_alert=True)
+    elif product_id in cart and cart[product_id] > 0:
+        cart[product_id] -= 1
+        stock_ledger.hold(product_id, update.effective_user.id, cart[product_id])
+        if cart[product_id] == 0:
+            del cart[product_id]
+            await answer_callback(query, f"🗑️ '{product_data['nome']}' removido completamente.")
+        else:
+            await answer_callback(query, f"➖ Uma unidade de '{product_data['nome']}' removida.")
+    else:
+        await answer_callback(query, f"'{product_data['nome']}' não está no carrinho.", show_alert=True)
+    await cart_handler(update, context) # Atualiza a mensagem do carrinho
+
+async def donate_amount_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, amount_cents: int) -> None:
+    """Callback 'donate_CENTAVOS': doação com valor pré-definido."""
+    await process_donation(update, context, amount_cents)
+
+async def donate_custom_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Callback 'donate_custom': pede ao usuário que digite o valor."""
+    await answer_callback(update.callback_query)
+    await update.callback_query.message.reply_text(
+        "💰 **Digite o valor desejado:**\n\nEx: 25 (para R$ 25,00)\nEx: 50.50 (para R$ 50,50)",
+        parse_mode="Markdown"
+    )
+    context.user_data['waiting_for_donation'] = True
+
+
+class CallbackRouter:
+    """Tabela de roteamento de `callback_data` para handlers.
+
+    Rotas exatas ('show_cart') e rotas com argumento inteiro ('add_one_<ID>',
+    'show_products:<página>') ficam em dicionários. O argumento é sempre o sufixo
+    numérico do callback, então basta remover os dígitos finais para achar o
+    prefixo: o despacho custa uma ou duas consultas a dicionário, qualquer que
+    seja o número de rotas.
+    """
+
+    _DIGITS = "0123456789"
+
+    def __init__(self):
+        self._exact: dict = {}
+        self._with_int: dict = {}
+
+    def add(self, data: str, handler) -> None:
+        """Registra `handler(update, context)` para um callback_data fixo."""
+        self._exact[data] = instrument_handler(handler, f"callback:{data}")
+
+    def add_int(self, prefix: str, handler) -> None:
+        """Registra `handler(update, context, valor)` para '<prefix><inteiro>'."""
+        self._with_int[prefix] = instrument_handler(handler, f"callback:{prefix}")
+
+    def resolve(self, data: str) -> Optional[tuple]:
+        """Retorna (handler, argumentos) para o callback, ou None se não houver rota."""
+        handler = self._exact.get(data)
+        if handler is not None:
+            return handler, ()
+        prefix = data.rstrip(self._DIGITS)
+        if prefix != data:
+            handler = self._with_int.get(prefix)
+            if handler is not None:
+                return handler, (int(data[len(prefix):]),)
+        return None
+
+
+callback_router = CallbackRouter()
+callback_router.add("show_products", products_handler)
+callback_router.add_int("show_products:", products_handler)
+callback_router.add("show_cart", cart_handler)
+callback_router.add_int("view_product_", view_product_handler)
+callback_router.add_int("add_one_", add_one_callback)
+callback_router.add_int("remove_one_", remove_one_callback)
+callback_router.add("checkout_cart", checkout_handler)
+callback_router.add("show_donation", donation_handler)
+callback_router.add("donate_custom", donate_custom_callback)
+callback_router.add_int("donate_", donate_amount_callback)
+callback_router.add_int("search:", search_handler)
+
 async def inline_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Processa todos os callbacks de botões inline."""
+    """Processa todos os callbacks de botões inline através do `callback_router`."""
     query = update.callback_query
-    data = query.data
-    logger.info(f"Callback recebido: {data}")
+    route = callback_router.resolve(query.data)
+    if route is None:
+        logger.debug("Callback sem rota: data=%r user=%s", query.data, query.from_user.id if query.from_user else None)
+        await answer_callback(query, "Ação não implementada.")
+        return
 
+    handler, args = route
+    logger.debug("Callback: data=%r handler=%s user=%s", query.data, handler.__name__, query.from_user.id if query.from_user else None)
     try:
-        if data == "show_products":
-            await products_handler(update, context)
-        elif data == "show_cart":
-            await cart_handler(update, context)
-        elif data.startswith("view_product_"):
-            await view_product_handler(update, context) # Reutiliza o handler
-        elif data.startswith("add_one_"):
-            try:
-                product_id = int(data.split("_")[-1])
-            except (IndexError, ValueError):
-                try:
-                    await query.answer("ID de produto inválido.", show_alert=True)
-                except:
-                    pass
-                return
-            
-            product_data = fetch_product_by_id(product_id)
-            if not product_data:
-                try:
-                    await query.answer("Produto não mais disponível.", show_alert=True)
-                except:
-                    pass
-                return
+        await handler(update, context, *args)
+    except Exception as e:
+        logger.error(f"Erro geral no handler de botões ({query.data}): {e}")
+        await answer_callback(query, "Erro ao processar ação. Tente novamente.", show_alert=True)
 
-            cart = get_cart(context)
-            cart[product_id] = cart.get(product_id, 0) + 1
-            try:
-                await query.answer(text=f"✅ '{product_data['nome']}' adicionado!")
-            except:
-                pass
+async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handler para o comando /help."""
+    await update.message.reply_text(HELP_TEXT, parse_mode="Markdown")
 
-        elif data.startswith("remove_one_"):
-            try:
-                product_id = int(data.split("_")[-1])
-            except (IndexError, ValueError):
-                try:
-                    await query.answer("ID de produto inválido.", show_alert=True)
-                except:
-                    pass
-                return
+def is_admin(update: Update) -> bool:
+    """Indica se o autor do update está em ADMIN_USER_IDS."""
+    return update.effective_user is not None and update.effective_user.id in ADMIN_USER_IDS
+
+async def status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handler para o comando administrativo /status (fila de updates e concorrência)."""
+    if not is_admin(update):
+        return
+    processor = context.application.update_processor
+    lines = ["📊 **Status do Bot:**\n"]
+    if isinstance(processor, PerUserUpdateProcessor):
+        stats = processor.stats()
+        lines += [
+            f"Updates em execução: {stats['active']}/{stats['limit']}",
+            f"Updates aguardando: {stats['waiting']} (limite de pendentes: {stats['capacity']})",
+            f"Updates processados: {stats['processed']}",
+            f"Espera média: {stats['avg_wait_ms']:.1f} ms (máx. {stats['max_wait_ms']:.1f} ms)",
+        ]
+    lines.append(f"Fila de entrada: {context.application.update_queue.qsize()}")
+    rate_limiter = context.bot.rate_limiter
+    if isinstance(rate_limiter, OutboundRateLimiter):
+        stats = rate_limiter.stats()
+        lines.append(f"Envios: {stats['sent']} (coalescidos: {stats['coalesced']}, reenviados após 429: {stats['retried']})")
+    stats = session_memory_stats(context.application)
+    lines.append(f"Sessões em memória: {stats['sessions']} (~{stats['bytes'] // 1024} KB, carrinhos: {stats['carts']}, itens: {stats['cart_items']})")
+    stats = render_cache.stats()
+    lines.append(f"Cache de cards: {stats['entries']} ({stats['bytes'] // 1024} KB, acertos: {stats['hits']}, falhas: {stats['misses']})")
+    stats = inline_result_cache.stats()
+    lines.append(f"Cache de buscas inline: {stats['entries']} (acertos: {stats['hits']}, falhas: {stats['misses']})")
+    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
 
-            cart = get_cart(context)
-            product_data = fetch_product_by_id(product_id)
+REPORT_MAX_DAYS = 366
 
-            if not product_data: # Produto não existe mais no DB
-                if product_id in cart: del cart[product_id]
-                try:
-                    await query.answer("Produto não encontrado. Removido do carrinho se estava lá.", show_alert=True)
-                except:
-                    pass
-                await cart_handler(update, context) # Atualiza a view do carrinho
-                return
+async def report_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handler para o comando administrativo /relatorio [dias] (vendas e doações do período)."""
+    if not is_admin(update):
+        return
+    try:
+        days = int(context.args[0]) if context.args else 7
+    except ValueError:
+        await update.message.reply_text("Uso: `/relatorio [dias]` (ex: `/relatorio 30`)", parse_mode="Markdown")
+        return
+    days = min(max(days, 1), REPORT_MAX_DAYS)
 
-            if product_id in cart and cart[product_id] > 0:
-                cart[product_id] -= 1
-                if cart[product_id] == 0:
-                    del cart[product_id]
-                    try:
-                        await query.answer(text=f"🗑️ '{product_data['nome']}' removido completamente.")
-                    except:
-                        pass
-                else:
-                    try:
-                        await query.answer(text=f"➖ Uma unidade de '{product_data['nome']}' removida.")
-                    except:
-                        pass
-                await cart_handler(update, context) # Atualiza a mensagem do carrinho
-            else:
-                try:
-                    await query.answer(text=f"'{product_data['nome']}' não está no carrinho.", show_alert=True)
-                except:
-                    pass
-                await cart_handler(update, context) # Atualiza para mostrar que sumiu (ou não estava)
-
-        elif data == "checkout_cart":
-            await checkout_handler(update, context)
-        elif data == "show_donation":
-            await donation_handler(update, context)
-        elif data.startswith("donate_"):
+    first_day = report_day(time.time() - (days - 1) * 86400)
+    started = time.perf_counter()
+    report = await get_db_pool().run(fetch_sales_report, first_day)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    lines = [
+        f"📈 **Relatório dos últimos {days} dia(s)** (desde {first_day})\n",
+        f"🛒 Pedidos: {report['orders']} - {Money(report['revenue_cents'])}",
+    ]
+    if report["products"]:
+        lines.append("\n🏆 **Mais vendidos:**")
+        for position, product in enumerate(report["products"], 1):
+            lines.append(
+                f"{position}. {escape_md(product['nome'])} - {product['quantity']} un. - {Money(product['revenue_cents'])}"
+            )
+    donation_count = sum(row["donations"] for row in report["donations"])
+    donation_total = sum(row["donations"] * row["amount_cents"] for row in report["donations"])
+    lines.append(f"\n💝 Doações: {donation_count} - {Money(donation_total)}")
+    for row in report["donations"]:
+        lines.append(f"   {Money(row['amount_cents'])} × {row['donations']}")
+    lines.append(f"\n⏱️ Consulta: {elapsed_ms:.1f} ms")
+    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+
+# --- Tarefas em Segundo Plano ---
+async def touch_session(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Marca a última atividade do usuário (roda antes de todos os handlers, no grupo -1)."""
+    if update.effective_user is not None:
+        context.user_data['last_seen'] = time.time()
+
+def session_memory_stats(application: Application) -> dict:
+    """Tamanho aproximado das sessões (user_data) mantidas em memória por este processo."""
+    sessions = carts = cart_items = size = 0
+    for data in application.user_data.values():
+        sessions += 1
+        size += sys.getsizeof(data)
+        cart = data.get('cart')
+        if cart:
+            carts += 1
+            cart_items += sum(cart.values())
+            size += sys.getsizeof(cart)
+    return {"sessions": sessions, "carts": carts, "cart_items": cart_items, "bytes": size}
+
+async def evict_idle_sessions(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Descarta as sessões (e carrinhos) sem atividade há mais de SESSION_TTL_SECONDS.
+
+    `drop_user_data` tira a sessão da memória e, no próximo flush da
+    persistência, apaga também a cópia gravada no SQLite.
+    """
+    application = context.application
+    cutoff = time.time() - SESSION_TTL_SECONDS
+    idle = [user_id for user_id, data in application.user_data.items() if data.get('last_seen', cutoff) < cutoff]
+    for user_id in idle:
+        stock_ledger.release(user_id, list(application.user_data[user_id].get('cart', {})))
+        application.drop_user_data(user_id)
+    if METRICS_ENABLED:
+        JOB_ITEMS.inc("evict_idle_sessions", len(idle))
+
+    stats = session_memory_stats(application)
+    logger.info(
+        f"Sessões em memória: {stats['sessions']} (~{stats['bytes'] // 1024} KB, {stats['carts']} carrinhos, "
+        f"{stats['cart_items']} itens); {len(idle)} descartadas por inatividade."
+    )
+
+CART_REMINDER_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🛒 Ver Carrinho", callback_data="show_cart")],
+    [InlineKeyboardButton("✅ Finalizar Compra", callback_data="checkout_cart")],
+])
+
+async def send_cart_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Lembra quem deixou itens no carrinho há mais de CART_REMINDER_SECONDS (uma vez por abandono).
+
+    Até CART_REMINDER_BATCH lembretes por rodada, enviados juntos: quem dita o
+    ritmo é o `OutboundRateLimiter`, que os encaixa nos limites do Telegram sem
+    atrasar as respostas aos usuários ativos mais do que a sua parte da cota.
+    """
+    application = context.application
+    cutoff = time.time() - CART_REMINDER_SECONDS
+    due = [
+        user_id for user_id, data in application.user_data.items()
+        if data.get('cart') and data.get('last_seen', cutoff) < cutoff
+        and data.get('cart_reminded_at', 0) < data.get('last_seen', 0)
+    ][:CART_REMINDER_BATCH]
+    if not due:
+        return
+
+    async def remind(user_id: int) -> bool:
+        data = application.user_data[user_id]
+        data['cart_reminded_at'] = time.time() # Marca antes de enviar: falhas não viram uma enxurrada de tentativas
+        pricing = await price_cart(data['cart'])
+        if not pricing.lines:
+            return False
+        items = sum(line.quantity for line in pricing.lines)
+        try:
+            await application.bot.send_message(
+                chat_id=user_id,
+                text=f"🛒 Você deixou {items} item(ns) no carrinho (total: {Money(pricing.total_cents)}).\nQuer finalizar a compra?",
+                reply_markup=CART_REMINDER_MARKUP,
+            )
+        except TelegramError as e: # Ex: o usuário bloqueou o bot
+            logger.debug(f"Lembrete de carrinho para {user_id} não enviado: {e}")
+            record_swallowed_error("send_cart_reminders")
+            return False
+        return True
+
+    sent = sum(await asyncio.gather(*(remind(user_id) for user_id in due)))
+    application.mark_data_for_update_persistence(user_ids=due)
+    if METRICS_ENABLED:
+        JOB_ITEMS.inc("send_cart_reminders", sent)
+    logger.info(f"Lembretes de carrinho abandonado: {sent} enviados de {len(due)}.")
+
+def run_db_maintenance(session_ttl: float) -> dict:
+    """Apaga sessões gravadas expiradas, atualiza as estatísticas do planejador e trunca o WAL.
+
+    O checkpoint nunca espera por quem está usando o banco: o PASSIVE copia o que der
+    do WAL, e o WAL só é truncado quando tudo foi copiado, com o `busy_timeout`
+    zerado (com leitores ou escritores ativos, o TRUNCATE fica para a próxima vez
+    em vez de segurar as requisições por até `DB_BUSY_TIMEOUT_MS`).
+    """
+    with get_db_pool().connection() as conn:
+        expired = 0
+        if session_ttl > 0: # Sessões de usuários que não voltaram a este processo desde o último restart
+            with conn:
+                expired = conn.execute("DELETE FROM user_sessions WHERE updated_at < ?", (time.time() - session_ttl,)).rowcount
+        conn.execute("PRAGMA analysis_limit=1000") # ANALYZE por amostragem: custo limitado mesmo com tabelas grandes
+        conn.execute("ANALYZE")
+        busy, wal_pages, checkpointed = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        truncated = False
+        if not busy and checkpointed == wal_pages:
+            conn.execute("PRAGMA busy_timeout=0")
             try:
-                if data == "donate_custom":
-                    try:
-                        await query.answer()
-                    except:
-                        pass
-                    await update.callback_query.message.reply_text(
-                        "💰 **Digite o valor desejado:**\n\nEx: 25 (para R$ 25,00)\nEx: 50.50 (para R$ 50,50)",
-                        parse_mode="Markdown"
-                    )
-                    context.user_data['waiting_for_donation'] = True
-                else:
-                    amount_cents = int(data.split("_")[-1])
-                    await process_donation(update, context, amount_cents)
-            except (IndexError, ValueError):
-                try:
-                    await query.answer("Erro ao processar doação.", show_alert=True)
-                except:
-                    pass
-        else:
+                truncated = not conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]
+            finally:
+                conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    return {
+        "expired_sessions": expired, "wal_busy": bool(busy), "wal_pages": wal_pages, "checkpointed": checkpointed,
+        "wal_truncated": truncated,
+    }
+
+async def db_maintenance(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Manutenção periódica do SQLite, em uma thread do pool (fora do caminho das requisições)."""
+    started = time.perf_counter()
+    result = await get_db_pool().run(run_db_maintenance, SESSION_TTL_SECONDS)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if result["wal_truncated"]:
+        checkpoint = f"WAL truncado ({result['checkpointed']} páginas)"
+    elif result["checkpointed"] == result["wal_pages"]:
+        checkpoint = f"checkpoint completo ({result['checkpointed']} páginas), WAL em uso e não truncado"
+    else:
+        checkpoint = f"WAL em uso, checkpoint parcial ({result['checkpointed']} de {result['wal_pages']} páginas)"
+    logger.info(f"Manutenção do banco em {elapsed_ms:.0f} ms: {result['expired_sessions']} sessões expiradas apagadas, ANALYZE, {checkpoint}.")
+
+def schedule_background_jobs(application: Application, db_maintenance_enabled: bool = True) -> None:
+    """Agenda as tarefas periódicas na JobQueue da Application.
+
+    No modo multi-worker só um worker (o 0) faz a manutenção do banco; a limpeza
+    de sessões e os lembretes rodam em todos, cada um sobre os seus usuários.
+    """
+    job_queue = application.job_queue
+    if job_queue is None:
+        logger.warning("JobQueue indisponível (instale python-telegram-bot[job-queue]); tarefas em segundo plano desativadas.")
+        return
+    if SESSION_TTL_SECONDS > 0:
+        job_queue.run_repeating(instrument_job(evict_idle_sessions), interval=SESSION_SWEEP_SECONDS, name="evict_idle_sessions")
+    if CART_REMINDER_SECONDS > 0:
+        job_queue.run_repeating(instrument_job(send_cart_reminders), interval=SESSION_SWEEP_SECONDS, name="send_cart_reminders")
+    if db_maintenance_enabled and DB_MAINTENANCE_SECONDS > 0:
+        job_queue.run_repeating(instrument_job(db_maintenance), interval=DB_MAINTENANCE_SECONDS, name="db_maintenance")
+
+async def close_db_pool(application: Application) -> None:
+    """Fecha as conexões do pool ao encerrar o bot."""
+    global _db_pool
+    if _db_pool is not None:
+        _db_pool.close()
+        _db_pool = None
+
+_metrics_server: Optional[asyncio.AbstractServer] = None
+_catalog_watcher: Optional[asyncio.Task] = None
+
+async def post_init(application: Application) -> None:
+    """Conclui a inicialização depois que a Application já se conectou ao Telegram."""
+    global _metrics_server, _catalog_watcher
+    await startup.wait_for_database()
+    _catalog_watcher = asyncio.create_task(catalog_cache.watch())
+    _metrics_server = await start_metrics_server()
+    startup.ready()
+
+async def shutdown(application: Application) -> None:
+    """Libera os recursos do processo ao encerrar o bot."""
+    global _metrics_server, _catalog_watcher
+    if _catalog_watcher is not None:
+        _catalog_watcher.cancel()
+        _catalog_watcher = None
+    if _metrics_server is not None:
+        _metrics_server.close()
+        _metrics_server = None
+    await close_db_pool(application)
+
+# --- Inicialização ---
+class Startup:
+    """Coordena e mede a inicialização do worker.
+
+    O banco (esquema, dados iniciais e leitura do catálogo) é preparado em uma
+    thread enquanto a Application é montada e faz as chamadas de rede iniciais
+    (getMe); o `post_init` só espera o que ainda faltar. Cada fase tem seu tempo
+    registrado, e `--profile-startup` mostra o relatório.
+    """
+
+    def __init__(self):
+        self.phases: list = [("imports", IMPORT_SECONDS)]
+        self._database = None
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    def _setup_database(self) -> CatalogSnapshot:
+        with self.phase("banco (esquema + dados iniciais + catálogo)"):
+            return setup_database()
+
+    def start_database(self) -> None:
+        """Dispara a preparação do banco em segundo plano."""
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="startup")
+        self._database = executor.submit(self._setup_database)
+        executor.shutdown(wait=False)
+
+    async def wait_for_database(self) -> None:
+        """Espera o banco ficar pronto e pré-carrega o cache do catálogo."""
+        if self._database is None:
+            return
+        with self.phase("espera pelo banco"):
+            snapshot = await asyncio.wrap_future(self._database)
+        catalog_cache.load(snapshot)
+        self._database = None
+
+    def ready(self) -> None:
+        total = time.perf_counter() - _IMPORTS_STARTED_AT
+        self.phases.append(("total até ficar pronto", total))
+        logger.info(f"Bot pronto em {total:.2f}s.")
+
+    def report(self) -> str:
+        return "\n".join(f"  {name:<45} {seconds * 1000:9.1f} ms" for name, seconds in self.phases)
+
+
+startup = Startup()
+
+async def profile_startup(application: Application) -> None:
+    """Executa a inicialização completa, sem começar a receber updates, e mostra os tempos."""
+    with startup.phase("initialize (getMe + persistência)"):
+        await application.initialize()
+    try:
+        await post_init(application)
+    finally:
+        await application.shutdown()
+    print("Tempos de inicialização:\n" + startup.report())
+
+# --- Webhook ---
+class WebhookApp:
+    """Aplicação ASGI mínima que recebe os updates do Telegram via webhook.
+
+    Valida o header `X-Telegram-Bot-Api-Secret-Token`, converte o JSON em
+    `Update` e o coloca na fila da `Application`. Quando o limite de updates
+    pendentes do `PerUserUpdateProcessor` (ou a fila) está cheio responde 503
+    para que o Telegram reenvie o update mais tarde.
+    Pode ser testada localmente enviando um POST com o JSON de um update gravado.
+    """
+
+    def __init__(self, application: Application, path: str = WEBHOOK_PATH, secret_token: str = WEBHOOK_SECRET):
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token.encode()
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+
+        if scope["path"] != self.path:
+            await self._respond(send, 404)
+            return
+        if scope["method"] != "POST":
+            await self._respond(send, 405)
+            return
+
+        headers = dict(scope["headers"])
+        if not hmac.compare_digest(headers.get(b"x-telegram-bot-api-secret-token", b""), self.secret_token):
+            await self._respond(send, 403)
+            return
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        await self._respond(send, self.enqueue(body))
+
+    def enqueue(self, body: bytes) -> int:
+        """Entrega o update recebido para processamento e retorna o status HTTP da resposta."""
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            logger.warning(f"Update inválido recebido no webhook: {e}")
+            return 400
+
+        processor = self.application.update_processor
+        admission = isinstance(processor, PerUserUpdateProcessor)
+        if admission and not processor.try_admit(update):
+            logger.warning("Limite de updates pendentes atingido; pedindo ao Telegram para reenviar.")
+            return 503
+        try:
+            self.application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            if admission:
+                processor.cancel_admission(update)
+            logger.warning("Fila de updates cheia; pedindo ao Telegram para reenviar.")
+            return 503
+        return 200
+
+    @staticmethod
+    async def _respond(send, status: int, body: bytes = b"") -> None:
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"text/plain")]})
+        await send({"type": "http.response.body", "body": body})
+
+
+class ShardedWebhookApp(WebhookApp):
+    """Receptor do modo multi-worker: só valida o update e o repassa a um worker.
+
+    O worker é escolhido pelo ID do usuário (ou do chat), a mesma chave do
+    `PerUserUpdateProcessor`, então todos os updates de um usuário caem sempre
+    no mesmo processo e continuam sendo tratados em ordem. O receptor não monta
+    o `Update`; o JSON segue como bytes e só é convertido no worker.
+    """
+
+    def __init__(self, worker_queues: list, path: str = WEBHOOK_PATH, secret_token: str = WEBHOOK_SECRET):
+        super().__init__(None, path, secret_token)
+        self.worker_queues = worker_queues
+
+    def enqueue(self, body: bytes) -> int:
+        try:
+            key = update_routing_key(json.loads(body))
+        except ValueError as e:
+            logger.warning(f"Update inválido recebido no webhook: {e}")
+            return 400
+
+        try:
+            self.worker_queues[key % len(self.worker_queues)].put_nowait(body)
+        except queue.Full:
+            logger.warning("Fila do worker cheia; pedindo ao Telegram para reenviar.")
+            return 503
+        return 200
+
+
+def update_routing_key(data: dict) -> int:
+    """ID do usuário (ou, na falta dele, do chat) de um update ainda em JSON."""
+    for value in data.values():
+        if isinstance(value, dict):
+            for field in ("from", "user", "chat"):
+                sender = value.get(field)
+                if isinstance(sender, dict) and "id" in sender:
+                    return sender["id"]
+    return 0
+
+
+async def run_webhook(application: Application) -> None:
+    """Registra o webhook no Telegram e serve o endpoint com uvicorn."""
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(
+        WebhookApp(application),
+        host=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        log_level="warning",
+        lifespan="off",
+    ))
+    async with application:
+        await application.post_init(application)
+        await application.bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+        await application.start()
+        logger.info(f"Webhook escutando em {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        try:
+            await server.serve()
+        finally:
+            await application.stop()
+    await shutdown(application)
+
+# --- Multi-worker ---
+def run_workers() -> None:
+    """Modo multi-worker: este processo recebe o webhook e `WORKERS` processos tratam os updates.
+
+    Todo o estado compartilhado (sessões, pedidos, estoque e a versão do catálogo)
+    fica no SQLite, então os workers não precisam conversar entre si.
+    """
+    setup_database() # Migrações e dados iniciais uma vez só, antes de os workers abrirem o banco
+    context = multiprocessing.get_context("spawn")
+    worker_queues = [context.Queue(maxsize=UPDATE_QUEUE_SIZE) for _ in range(WORKERS)]
+    workers = [start_worker(context, index, worker_queue) for index, worker_queue in enumerate(worker_queues)]
+    try:
+        asyncio.run(serve_sharded_webhook(worker_queues, lambda: supervise_workers(context, workers, worker_queues)))
+    finally:
+        for worker_queue in worker_queues:
+            worker_queue.put(None)
+        for worker in workers:
+            worker.join(timeout=30)
+
+def start_worker(context, index: int, worker_queue):
+    worker = context.Process(target=worker_main, args=(index, worker_queue), name=f"worker-{index}")
+    worker.start()
+    return worker
+
+async def supervise_workers(context, workers: list, worker_queues: list) -> None:
+    """Recria o worker que morrer, com uma fila nova.
+
+    O processo morto pode ter ficado com a trava de leitura da fila (estava parado em `get`),
+    então o novo worker recebe outra fila, com o que ainda der para ler da antiga (o que
+    não der se perde, como os updates que o worker estava tratando).
+    """
+    while True:
+        await asyncio.sleep(WORKER_CHECK_SECONDS)
+        for index, worker in enumerate(workers):
+            if worker.is_alive():
+                continue
+            logger.error(f"Worker {index} encerrou (código {worker.exitcode}); iniciando outro.")
+            old_queue, new_queue = worker_queues[index], context.Queue(maxsize=UPDATE_QUEUE_SIZE)
+            moved = 0
             try:
-                await query.answer(text="Ação não implementada.")
-            except:
+                while True:
+                    new_queue.put_nowait(old_queue.get_nowait())
+                    moved += 1
+            except (queue.Empty, queue.Full):
                 pass
-    except Exception as e:
-        logger.error(f"Erro geral no handler de botões: {e}")
+            if moved:
+                logger.info(f"Worker {index}: {moved} updates passados para a fila nova.")
+            worker_queues[index] = new_queue # O ShardedWebhookApp usa a mesma lista
+            workers[index] = start_worker(context, index, new_queue)
+
+async def serve_sharded_webhook(worker_queues: list, supervisor=None) -> None:
+    """Registra o webhook e serve o `ShardedWebhookApp` até o processo ser encerrado.
+
+    `supervisor`, se informado, é chamado para criar a tarefa que vigia os workers enquanto o servidor roda.
+    """
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(
+        ShardedWebhookApp(worker_queues),
+        host=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        log_level="warning",
+        lifespan="off",
+    ))
+    async with Bot(TELEGRAM_BOT_TOKEN, **bot_api_urls()) as bot:
+        await bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    logger.info(f"Webhook escutando em {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH} com {len(worker_queues)} workers")
+    supervision = asyncio.create_task(supervisor()) if supervisor else None
+    try:
+        await server.serve()
+    finally:
+        if supervision:
+            supervision.cancel()
+
+def worker_main(index: int, updates) -> None:
+    """Processo worker: trata, em ordem por usuário, os updates repassados pelo receptor."""
+    # Quem encerra o worker é o receptor (com um None na fila), depois de parar de aceitar updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    global METRICS_PORT
+    METRICS_PORT += index # Cada worker expõe as próprias métricas: 9100, 9101, ...
+    startup.start_database()
+    # O limite global do Telegram vale para o bot inteiro, então é dividido entre os workers
+    application = build_application(db_maintenance=index == 0, outbound_global_rate=OUTBOUND_GLOBAL_RATE / WORKERS)
+    asyncio.run(_run_worker(index, application, updates))
+
+async def _run_worker(index: int, application: Application, updates) -> None:
+    loop = asyncio.get_running_loop()
+    async with application:
+        await application.post_init(application)
+        await application.start()
+        logger.info(f"Worker {index} pronto.")
         try:
-            await query.answer(text="Erro ao processar ação. Tente novamente.", show_alert=True)
-        except:
-            pass
+            while (body := await loop.run_in_executor(None, updates.get)) is not None:
+                try:
+                    update = Update.de_json(json.loads(body), application.bot)
+                except Exception as e:
+                    # JSON válido, mas não é um update que a biblioteca aceite: descarta e segue com a fila
+                    logger.warning(f"Worker {index}: update inválido descartado: {e}")
+                    continue
+                # Sem vaga, o worker para de consumir: a fila do processo enche e o receptor responde 503
+                await application.update_processor.admit(update)
+                await application.update_queue.put(update)
+        finally:
+            await application.stop()
+    await shutdown(application)
 
-async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handler para o comando /help."""
-    help_text = (
-        "🤖 **Comandos:**\n"
-        "/start - Iniciar conversa\n"
-        "/produtos - Listar produtos\n"
-        "/ver `<ID>` - Ver detalhes de um produto\n"
-        "/adicionar `<ID>` - Adicionar produto ao carrinho\n"
-        "/remover `<ID>` - Remover produto do carrinho\n"
-        "/carrinho - Ver seu carrinho\n"
-        "/finalizar - Finalizar compra (simulação)\n"
-        "/doar - Fazer uma doação\n"
-        "/help - Mostrar esta ajuda"
+
+def bot_api_urls() -> dict:
+    """Argumentos `base_url`/`base_file_url` do `Bot` quando `TELEGRAM_API_URL` está definida."""
+    if not TELEGRAM_API_URL:
+        return {}
+    url = TELEGRAM_API_URL.rstrip("/")
+    return {"base_url": f"{url}/bot", "base_file_url": f"{url}/file/bot"}
+
+def build_application(
+    db_maintenance: bool = True, outbound_global_rate: float = OUTBOUND_GLOBAL_RATE, persistence: bool = True,
+) -> Application:
+    """Cria a Application, registra todos os handlers e agenda as tarefas em segundo plano.
+
+    `persistence=False` deixa as sessões só na memória (usado pelo `benchmarks.py` para comparar).
+    """
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .rate_limiter(OutboundRateLimiter(global_rate=outbound_global_rate))
+        .post_init(post_init)
+        .post_shutdown(shutdown)
+    )
+    if persistence:
+        builder = builder.persistence(SQLiteSessionPersistence())
+    if TELEGRAM_API_URL:
+        urls = bot_api_urls()
+        builder = builder.base_url(urls["base_url"]).base_file_url(urls["base_file_url"])
+    if BOT_MODE == "webhook":
+        # Os updates chegam pelo nosso endpoint ASGI, não pelo Updater
+        builder = builder.updater(None).update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+    application = builder.build()
+
+    application.add_handler(TypeHandler(Update, touch_session), group=-1)
+    application.add_handler(CommandHandler("start", instrument_handler(start_handler)))
+    application.add_handler(CommandHandler("produtos", instrument_handler(products_handler)))
+    application.add_handler(CommandHandler("adicionar", instrument_handler(add_to_cart_handler)))
+    application.add_handler(CommandHandler("remover", instrument_handler(remove_from_cart_handler)))
+    application.add_handler(CommandHandler("carrinho", instrument_handler(cart_handler)))
+    application.add_handler(CommandHandler("finalizar", instrument_handler(checkout_handler)))
+    application.add_handler(CommandHandler("doar", instrument_handler(donation_handler)))
+    application.add_handler(CommandHandler("help", instrument_handler(help_handler)))
+    application.add_handler(CommandHandler("ver", instrument_handler(view_product_handler))) # Comando direto /ver ID
+    application.add_handler(CommandHandler("buscar", instrument_handler(search_handler)))
+    application.add_handler(CommandHandler("status", instrument_handler(status_handler)))
+    application.add_handler(CommandHandler("relatorio", instrument_handler(report_handler)))
+    application.add_handler(InlineQueryHandler(instrument_handler(inline_query_handler)))
+
+    application.add_handler(CallbackQueryHandler(inline_button_handler))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrument_handler(text_message_handler)))
+    schedule_background_jobs(application, db_maintenance)
+    return application
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Bot de vendas para Telegram.")
+    parser.add_argument(
+        "--warmup-images", metavar="CHAT_ID", type=int,
+        help="Envia as imagens do catálogo para o chat informado, guarda os file_id e sai.",
+    )
+    parser.add_argument("--import-catalog", metavar="ARQUIVO", help="Importa produtos de um CSV/JSONL (upsert por SKU) e sai.")
+    parser.add_argument("--export-catalog", metavar="ARQUIVO", help="Exporta os produtos para CSV/JSONL e sai.")
+    parser.add_argument("--format", choices=("csv", "jsonl"), help="Formato do arquivo (padrão: pela extensão).")
+    parser.add_argument(
+        "--profile-startup", action="store_true",
+        help="Executa a inicialização (imports, banco, conexão com o Telegram), mostra o tempo de cada fase e sai.",
     )
-    await update.message.reply_text(help_text, parse_mode="Markdown")
+    return parser.parse_args(argv)
 
 def main() -> None:
     """Função principal para iniciar o bot."""
+    args = parse_args()
+    if args.import_catalog or args.export_catalog:
+        initialize_database()
+        if args.import_catalog:
+            import_catalog(args.import_catalog, args.format)
+        if args.export_catalog:
+            export_catalog(args.export_catalog, args.format)
+        return
+
     if not TELEGRAM_BOT_TOKEN or TELEGRAM_BOT_TOKEN == "SEU_TOKEN_AQUI_INVALIDO":
         logger.critical("ERRO: Token do Telegram não configurado.")
         return
+    if args.warmup_images is None and not args.profile_startup and BOT_MODE == "webhook" and not WEBHOOK_URL:
+        logger.critical("ERRO: BOT_MODE=webhook exige a variável WEBHOOK_URL.")
+        return
 
-    initialize_database()
-    populate_initial_data()
+    if args.warmup_images is not None:
+        catalog_cache.load(setup_database())
+        asyncio.run(warmup_product_images(args.warmup_images))
+        return
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    if BOT_MODE == "webhook" and WORKERS > 1 and not args.profile_startup:
+        logger.info(f"Bot iniciando em modo webhook com {WORKERS} workers...")
+        run_workers()
+        return
 
-    application.add_handler(CommandHandler("start", start_handler))
-    application.add_handler(CommandHandler("produtos", products_handler))
-    application.add_handler(CommandHandler("adicionar", add_to_cart_handler))
-    application.add_handler(CommandHandler("remover", remove_from_cart_handler))
-    application.add_handler(CommandHandler("carrinho", cart_handler))
-    application.add_handler(CommandHandler("finalizar", checkout_handler))
-    application.add_handler(CommandHandler("doar", donation_handler))
-    application.add_handler(CommandHandler("help", help_handler))
-    application.add_handler(CommandHandler("ver", view_product_handler)) # Comando direto /ver ID
+    # O banco fica pronto em paralelo com a montagem da Application e o getMe
+    startup.start_database()
+    with startup.phase("build_application"):
+        application = build_application()
 
-    application.add_handler(CallbackQueryHandler(inline_button_handler))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_message_handler))
+    if args.profile_startup:
+        asyncio.run(profile_startup(application))
+        return
 
-    logger.info("Bot iniciando polling...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == "webhook":
+        logger.info("Bot iniciando em modo webhook...")
+        asyncio.run(run_webhook(application))
+    else:
+        logger.info("Bot iniciando polling...")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == "__main__":
     main()